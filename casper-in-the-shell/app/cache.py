@@ -0,0 +1,58 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache():
+    """Bounded mapping that drops the least recently used entries once the total weight
+    of its values goes over max_weight (each value weighs 1 unless a weight function is given)."""
+
+    def __init__(self, max_weight, weight=None):
+        self.max_weight = max_weight
+        self.weight = weight or (lambda value: 1)
+        self.entries = OrderedDict()
+        self.total = 0
+        self.lock = Lock()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def set(self, key, value):
+        weight = self.weight(value)
+        with self.lock:
+            if key in self.entries:
+                self.total -= self.entries.pop(key)[1]
+            self.entries[key] = (value, weight)
+            self.total += weight
+            while self.total > self.max_weight and len(self.entries) > 1:
+                self.total -= self.entries.popitem(last=False)[1][1]
+
+    def reweigh(self, key):
+        #For values that grow in place, eg. an index getting new commands.
+        with self.lock:
+            if key in self.entries:
+                value, weight = self.entries[key]
+                self.entries[key] = (value, self.weight(value))
+                self.total += self.entries[key][1] - weight
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value, weight = self.entries.pop(key)
+            self.total -= weight
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total = 0
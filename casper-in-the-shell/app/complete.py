@@ -0,0 +1,109 @@
+from bisect import bisect_left, insort
+from heapq import nlargest
+
+from app.cache import LRUCache
+from app.invalidation import COMPLETIONS, invalidations
+from app.sql.env_init import COMPLETE_CACHE_MAX_COMMANDS
+from app.utils import frecency_add
+
+#Sorts after every other character, prefix + this is the upper bound of the prefix range.
+MAX_CHAR = "\U0010ffff"
+
+
+class PrefixIndex():
+    """A user's commands sorted lexicographically for prefix lookups, plus the same commands
+    in rank order so dense prefixes (short ones, or none at all) can walk from the top instead.
+    Rank is (frecency, id), see utils.frecency_add."""
+
+    def __init__(self, rows):
+        self.ranks = {row.command: (row.frecency, row.id) for row in rows}
+        self.sorted = sorted(self.ranks)
+        self.by_rank = sorted(self.ranks, key=self.ranks.get)
+
+    def __len__(self):
+        return len(self.sorted)
+
+    def add(self, command_id, command, use):
+        old = self.ranks.get(command)
+        if old is None:
+            insort(self.sorted, command)
+        else:
+            del self.by_rank[bisect_left(self.by_rank, old, key=self.ranks.get)]
+        rank = (frecency_add(old[0] if old else None, use), command_id)
+        self.ranks[command] = rank
+        self.by_rank.insert(bisect_left(self.by_rank, rank, key=self.ranks.get), command)
+
+    def complete(self, prefix, limit):
+        lo = bisect_left(self.sorted, prefix)
+        hi = bisect_left(self.sorted, prefix + MAX_CHAR, lo)
+        if hi - lo <= limit:
+            return sorted(self.sorted[lo:hi], key=self.ranks.get, reverse=True)
+        if (hi - lo) * 32 < len(self.sorted):
+            return nlargest(limit, self.sorted[lo:hi], key=self.ranks.get)
+        #At least one in 32 commands matches, so walking from the top finds limit of them quickly.
+        found = []
+        for command in reversed(self.by_rank):
+            if command.startswith(prefix):
+                found.append(command)
+                if len(found) == limit:
+                    break
+        return found
+
+
+class CompletionIndexes():
+    """Per-user PrefixIndex objects, built on first use and evicted least recently used first
+    once they hold more than COMPLETE_CACHE_MAX_COMMANDS commands altogether."""
+
+    def __init__(self, max_commands):
+        self.indexes = LRUCache(max_commands, weight=len)
+        #users whose index is being built, a write while building makes the result stale.
+        self.building = {}
+
+    async def get(self, user_id, load):
+        invalidations.poll()
+        index = self.indexes.get(user_id)
+        if index is None:
+            token = object()
+            self.building[user_id] = token
+            try:
+                index = PrefixIndex(await load())
+                #another worker's write while loading drops the token just like a local one.
+                invalidations.poll()
+                if self.building.get(user_id) is token:
+                    self.indexes.set(user_id, index)
+            finally:
+                #a failed or invalidated build doesn't leave its entry behind, a newer build's token is kept.
+                building = self.building.get(user_id, token)
+                if building is token or building is None:
+                    self.building.pop(user_id, None)
+        return index
+
+    def add(self, user_id, command_id, command, use):
+        invalidations.poll()
+        index = self.indexes.get(user_id)
+        if index is not None and command_id:
+            index.add(command_id, command, use)
+            self.indexes.reweigh(user_id)
+            #the other workers' copies can't be updated from here, they rebuild theirs.
+            invalidations.publish(COMPLETIONS, user_id)
+        else:
+            self.invalidate(user_id)
+
+    def drop(self, user_id):
+        self.indexes.pop(user_id)
+        if user_id in self.building:
+            self.building[user_id] = None
+
+    def clear(self):
+        self.indexes.clear()
+        for user_id in self.building:
+            self.building[user_id] = None
+
+    def invalidate(self, user_id):
+        #here and in the other workers.
+        self.drop(user_id)
+        invalidations.publish(COMPLETIONS, user_id)
+
+
+completion_indexes = CompletionIndexes(COMPLETE_CACHE_MAX_COMMANDS)
+invalidations.subscribe(COMPLETIONS, completion_indexes.drop, completion_indexes.clear)
@@ -0,0 +1,139 @@
+import fcntl
+import os
+import stat
+import struct
+import tempfile
+from hashlib import blake2b
+from mmap import mmap
+from threading import Lock
+
+from app.sql.env_init import (CACHE_INVALIDATION_FILE, CACHE_INVALIDATION_SLOTS,
+                              MYSQL_DB, MYSQL_HOST, SQL_BACKEND, SQL_URL,
+                              SQLITE_PATH)
+
+#What a slot invalidates, the same numbers in every worker.
+MACROS = 1
+COMPLETIONS = 2
+#anything of the user's changed, see user_wrote.
+WRITES = 3
+
+HEADER = struct.Struct("<Q")
+#sequence number, user id, kind.
+SLOT = struct.Struct("<QqB7x")
+
+
+class InvalidationLog():
+    """Tells the other server workers on this host which users' cached data went stale.
+
+    Workers share a memory mapped file holding the latest sequence number and a ring of the last
+    `slots` invalidations. publish appends under an exclusive flock; poll, called before a cache is
+    used, compares the sequence number with the last one it applied (an 8 byte read, no syscall)
+    and drops the named users' entries from its own caches. A worker that fell more than a ring
+    behind, or read a slot being overwritten, clears its caches instead."""
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self.handlers = {}
+        self.lock = Lock()
+        self.fd = None
+        self.map = None
+        self.pid = None
+        self.seen = 0
+
+    def subscribe(self, kind, drop, clear):
+        self.handlers.setdefault(kind, []).append((drop, clear))
+
+    def mapping(self):
+        #opened again in each process, flocks on a descriptor inherited through fork would be shared with the parent.
+        if self.pid != os.getpid():
+            size = HEADER.size + SLOT.size * self.slots
+            #O_NOFOLLOW, a symlink planted at the path doesn't get another file overwritten.
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                current = os.fstat(fd).st_size
+                if current == 0:
+                    os.ftruncate(fd, size)
+                elif current != size:
+                    #shrinking it would crash (SIGBUS) the workers still mapping it, eg. the old ones of a rolling restart.
+                    raise RuntimeError(f"{self.path} was made with another CACHE_INVALIDATION_SLOTS, stop the workers "
+                                       "using it and delete it, or give this deployment its own CACHE_INVALIDATION_FILE.")
+                self.map = mmap(fd, size)
+            except BaseException:
+                #closing lets go of the flock too.
+                os.close(fd)
+                raise
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            self.fd = fd
+            self.pid = os.getpid()
+            self.seen = HEADER.unpack_from(self.map, 0)[0]
+        return self.map
+
+    def publish(self, kind, user_id, local=False):
+        #local also runs this worker's handlers, otherwise the caller has updated its own cache already.
+        if local:
+            for drop, clear in self.handlers.get(kind, ()):
+                drop(user_id)
+        if not self.path:
+            return
+        with self.lock:
+            mapping = self.mapping()
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                seq = HEADER.unpack_from(mapping, 0)[0] + 1
+                SLOT.pack_into(mapping, HEADER.size + SLOT.size * (seq % self.slots), seq, user_id, kind)
+                HEADER.pack_into(mapping, 0, seq)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            #this worker already dropped its own entries, nothing to replay if it was up to date.
+            if self.seen == seq - 1:
+                self.seen = seq
+
+    def poll(self):
+        if not self.path:
+            return
+        with self.lock:
+            mapping = self.mapping()
+            latest = HEADER.unpack_from(mapping, 0)[0]
+            if latest == self.seen:
+                return
+            stale = []
+            if latest - self.seen <= self.slots:
+                for seq in range(self.seen + 1, latest + 1):
+                    slot_seq, user_id, kind = SLOT.unpack_from(mapping, HEADER.size + SLOT.size * (seq % self.slots))
+                    if slot_seq != seq:
+                        break
+                    stale.append((kind, user_id))
+                else:
+                    self.seen = latest
+            if self.seen != latest:
+                self.seen = latest
+                for handlers in self.handlers.values():
+                    for drop, clear in handlers:
+                        clear()
+                return
+        for kind, user_id in stale:
+            for drop, clear in self.handlers.get(kind, ()):
+                drop(user_id)
+
+
+def default_path():
+    #A directory only this user can use, nobody else can plant a file or symlink in it. One file per
+    # deployment (checkout, working directory and database), deployments sharing a host don't share slots.
+    directory = os.path.join(tempfile.gettempdir(), f"cins-{os.getuid()}")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise RuntimeError(f"{directory} has to be a directory only this user can access, remove it or set CACHE_INVALIDATION_FILE.")
+    deployment = "\0".join(str(value) for value in (os.path.dirname(os.path.abspath(__file__)), os.getcwd(),
+                                                     SQL_URL, SQL_BACKEND, SQLITE_PATH, MYSQL_HOST, MYSQL_DB))
+    return os.path.join(directory, "cache-invalidation-" + blake2b(deployment.encode(), digest_size=8).hexdigest())
+
+
+invalidations = InvalidationLog(default_path() if CACHE_INVALIDATION_FILE is None else CACHE_INVALIDATION_FILE, CACHE_INVALIDATION_SLOTS)
+
+
+def user_wrote(user_id):
+    #Called after a user's save is committed, whatever caches or routes by their data is told here and in the other workers.
+    invalidations.publish(WRITES, user_id, local=True)
@@ -0,0 +1,55 @@
+import asyncio
+
+from app.invalidation import WRITES, invalidations
+from app.sql.env_init import LIVE_SYNC_POLL_SECONDS
+
+
+class SyncHub():
+    """Wakes the /ws/sync connections of a user whenever something of theirs is saved.
+
+    Connections wait on an asyncio.Event each, notify sets the events of the user's ones. Saves in
+    this worker call it through invalidation.user_wrote, saves in the other workers arrive through
+    the invalidation log, which nothing else reads while no requests come in, so a task polls it
+    every poll_seconds for as long as anyone is connected. Anything else that can call notify per
+    user (eg. a broker shared by several hosts) can stand in for the log."""
+
+    def __init__(self, poll_seconds):
+        self.poll_seconds = poll_seconds
+        self.users = {}
+        self.poller = None
+
+    def subscribe(self, user_id):
+        event = asyncio.Event()
+        self.users.setdefault(user_id, set()).add(event)
+        if self.poller is None:
+            self.poller = asyncio.ensure_future(self.poll())
+        return event
+
+    def unsubscribe(self, user_id, event):
+        events = self.users.get(user_id)
+        if events is not None:
+            events.discard(event)
+            if not events:
+                del self.users[user_id]
+
+    def notify(self, user_id):
+        for event in self.users.get(user_id, ()):
+            event.set()
+
+    def notify_all(self):
+        #this worker missed some saves, everyone checks for theirs.
+        for events in self.users.values():
+            for event in events:
+                event.set()
+
+    async def poll(self):
+        try:
+            while self.users:
+                invalidations.poll()
+                await asyncio.sleep(self.poll_seconds)
+        finally:
+            self.poller = None
+
+
+sync_hub = SyncHub(LIVE_SYNC_POLL_SECONDS)
+invalidations.subscribe(WRITES, sync_hub.notify, sync_hub.notify_all)
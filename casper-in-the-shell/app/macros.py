@@ -0,0 +1,49 @@
+from app.cache import LRUCache
+from app.invalidation import MACROS, invalidations
+from app.sql.env_init import MACRO_CACHE_SIZE
+
+
+class MacroCache():
+    """Expanded macros and macro name lists per user. Macros don't change once saved, so entries
+    live until the user saves another one, least recently used users are dropped first once
+    MACRO_CACHE_SIZE entries are held altogether."""
+
+    def __init__(self, max_entries):
+        self.users = LRUCache(max_entries, weight=len)
+
+    async def get(self, user_id, key, load):
+        invalidations.poll()
+        entries = self.users.get(user_id)
+        if entries is None:
+            entries = {}
+            self.users.set(user_id, entries)
+        elif key in entries:
+            return entries[key]
+        value = await load()
+        invalidations.poll()
+        #a save while loading replaced or dropped the entries, the loaded value may be stale then.
+        if self.users.get(user_id) is entries:
+            entries[key] = value
+            self.users.reweigh(user_id)
+        return value
+
+    async def macro(self, user_id, name, load):
+        return await self.get(user_id, ("macro", name), load)
+
+    async def names(self, user_id, load):
+        return await self.get(user_id, "names", load)
+
+    def drop(self, user_id):
+        self.users.pop(user_id)
+
+    def clear(self):
+        self.users.clear()
+
+    def invalidate(self, user_id):
+        #here and in the other workers.
+        self.drop(user_id)
+        invalidations.publish(MACROS, user_id)
+
+
+macro_cache = MacroCache(MACRO_CACHE_SIZE)
+invalidations.subscribe(MACROS, macro_cache.drop, macro_cache.clear)
@@ -1,15 +1,52 @@
 from fastapi import FastAPI
 
-app = FastAPI(root_path="/api")
+from .responses import JSONResponse
+
+app = FastAPI(root_path="/api", default_response_class=JSONResponse)
 
 from sqlalchemy import create_engine
-from sqlalchemy.pool import NullPool
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from .metrics import instrument_engine
+from .middleware import (GzipRequestMiddleware, GzipResponseMiddleware,
+                         MetricsMiddleware)
+from .sql import backend, env_init
+from .sql.pool import MeteredAsyncQueuePool, MeteredQueuePool
+
+driver = "mysql+"+env_init.SQL_ASYNC_DRIVER if env_init.SQL_ASYNC else "mysql"
 
-from .sql import env_init
+def mysql_url(host):
+    return driver+"://"+env_init.MYSQL_USER+":"+env_init.MYSQL_PASSWORD+"@"+host+"/"+env_init.MYSQL_DB
 
-sql_engine = create_engine(
-                "mysql://"+env_init.MYSQL_USER+":"+env_init.MYSQL_PASSWORD+"@db/"+env_init.MYSQL_DB,
-                isolation_level="READ UNCOMMITTED",poolclass=NullPool
+sql_url = env_init.SQL_URL or (backend.sqlite_url(env_init.SQLITE_PATH) if backend.SQLITE else mysql_url(env_init.MYSQL_HOST))
+replica_urls = env_init.SQL_REPLICA_URLS or [mysql_url(host) for host in env_init.MYSQL_REPLICA_HOSTS]
+pool_options = dict(
+                pool_size=env_init.SQL_POOL_SIZE,max_overflow=env_init.SQL_MAX_OVERFLOW,
+                pool_timeout=env_init.SQL_POOL_TIMEOUT,pool_recycle=env_init.SQL_POOL_RECYCLE,
+                pool_pre_ping=env_init.SQL_POOL_PRE_PING
                 )
 
+def make_engine(url):
+    if env_init.SQL_ASYNC:
+        engine = create_async_engine(url,poolclass=MeteredAsyncQueuePool,**backend.engine_options(),**pool_options)
+    else:
+        engine = create_engine(url,poolclass=MeteredQueuePool,**backend.engine_options(),**pool_options)
+    backend.prepare_engine(engine)
+    #events are registered on the sync engine, an async engine runs on one underneath.
+    instrument_engine(getattr(engine, "sync_engine", engine))
+    return engine
+
+if backend.SQLITE:
+    backend.create_schema(sql_url)
+sql_engine = make_engine(sql_url)
+#read only handlers are sent here, see sql_connection.ReplicaRouter.
+replica_engines = [make_engine(url) for url in replica_urls]
+
+app.add_middleware(GzipRequestMiddleware, max_size=env_init.REQUEST_MAX_BYTES)
+#level 9 (the default) takes about 7 times longer than 5 for a 1-2% smaller body, see bench/encode.py.
+app.add_middleware(GzipResponseMiddleware, minimum_size=env_init.RESPONSE_GZIP_MIN_BYTES, compresslevel=5)
+#added last so it runs first, its timings and sizes include the gzip work and bytes.
+if env_init.METRICS_ENABLED or env_init.SERVER_TIMING:
+    app.add_middleware(MetricsMiddleware, router=app.router, server_timing=env_init.SERVER_TIMING)
+
 from . import views_api
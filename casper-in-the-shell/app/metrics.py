@@ -0,0 +1,157 @@
+import logging
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+
+from sqlalchemy import event
+
+from app.sql.env_init import SLOW_QUERY_MS
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+slow_query_log = logging.getLogger("cins.slow_query")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter():
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = Lock()
+        self.values = {}
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram():
+    """Cumulative buckets the way prometheus expects them, kept per label combination.
+    observe is called from the threadpool in threaded mode, hence the lock."""
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = Lock()
+        self.values = {}
+
+    def observe(self, value, *labels):
+        #counts[i] is observations in (buckets[i-1], buckets[i]], the last one is +Inf.
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), labels + (bound,))} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+def single(name, kind, help, value):
+    return [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+
+
+request_seconds = Histogram("cins_http_request_duration_seconds", "Time from receiving a request to sending the last byte of its response.",
+                            ("method", "route", "status"))
+response_bytes = Histogram("cins_http_response_size_bytes", "Response body bytes as sent, after compression.",
+                           ("method", "route"), SIZE_BUCKETS)
+query_seconds = Histogram("cins_sql_query_duration_seconds", "Time spent executing statements, by the sql_queries builder that made them.",
+                          ("builder",), QUERY_BUCKETS)
+query_rows = Counter("cins_sql_rows_returned_total", "Rows fetched from select statements, by builder.", ("builder",))
+query_errors = Counter("cins_sql_errors_total", "Statements that raised, by builder.", ("builder",))
+slow_queries = Counter("cins_sql_slow_queries_total", "Statements slower than SLOW_QUERY_MS, by builder.", ("builder",))
+
+#Database time of the request being served, the middleware sets it and the engine hooks add to it.
+#Threadpool calls run in a copy of the context, the RequestTiming instance in it is still the same one.
+request_timing = ContextVar("request_timing", default=None)
+
+
+class RequestTiming():
+    def __init__(self):
+        self.start = perf_counter()
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def server_timing(self):
+        total = (perf_counter() - self.start) * 1000
+        return f'db;dur={self.query_seconds * 1000:.1f};desc="{self.queries} queries", total;dur={total:.1f}'
+
+
+def builder_of(execution_options):
+    return execution_options.get("builder", "orm")
+
+
+def record_rows(query, rows):
+    query_rows.inc(len(rows), builder_of(query.get_execution_options()))
+    return rows
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - conn.info["query_start"].pop()
+    builder = builder_of(context.execution_options)
+    query_seconds.observe(elapsed, builder)
+    timing = request_timing.get()
+    if timing is not None:
+        timing.queries += 1
+        timing.query_seconds += elapsed
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_queries.inc(1, builder)
+        #the statement without its parameters, they hold users' commands.
+        slow_query_log.warning("%s took %.1f ms: %s", builder, elapsed * 1000, " ".join(statement.split())[:1000])
+
+
+def handle_error(exception_context):
+    starts = exception_context.connection.info.get("query_start") if exception_context.connection is not None else None
+    if starts:
+        starts.pop()
+    context = exception_context.execution_context
+    query_errors.inc(1, builder_of(context.execution_options) if context is not None else "connect")
+
+
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(engine, "handle_error", handle_error)
+
+
+def render(extra=()):
+    """Every metric in the prometheus text format, extra holds (name, kind, help, value) read at scrape time."""
+    lines = []
+    for metric in (request_seconds, response_bytes, query_seconds, query_rows, query_errors, slow_queries):
+        lines += metric.render()
+    for name, kind, help, value in extra:
+        lines += single(name, kind, help, value)
+    return "\n".join(lines) + "\n"
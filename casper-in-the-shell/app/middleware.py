@@ -0,0 +1,128 @@
+import gzip
+import io
+import zlib
+from time import perf_counter
+
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+from starlette.routing import Match
+
+from app import metrics
+from app.responses import JSONResponse
+
+
+class GzipRequestMiddleware():
+    """Inflates request bodies sent with Content-Encoding: gzip before they reach the handlers,
+    refusing bodies that inflate to more than max_size bytes."""
+
+    def __init__(self, app, max_size):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or dict(scope["headers"]).get(b"content-encoding", b"").lower() != b"gzip":
+            await self.app(scope, receive, send)
+            return
+        #wbits 31 reads the gzip header and trailer, max_length stops a small body inflating without bound.
+        inflater = zlib.decompressobj(wbits=31)
+        body = bytearray()
+        more_body = True
+        try:
+            while more_body:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                body += inflater.decompress(message.get("body", b""), self.max_size + 1 - len(body))
+                if len(body) > self.max_size or inflater.unconsumed_tail:
+                    await JSONResponse(content={"detail": f"Body inflates to more than {self.max_size} bytes."}, status_code=413)(scope, receive, send)
+                    return
+                more_body = message.get("more_body", False)
+            if not inflater.eof:
+                raise zlib.error("truncated")
+        except zlib.error:
+            await JSONResponse(content={"detail": "Body is not valid gzip."}, status_code=400)(scope, receive, send)
+            return
+        headers = [(key, value) for key, value in scope["headers"] if key not in (b"content-encoding", b"content-length")]
+        scope = dict(scope, headers=headers + [(b"content-length", str(len(body)).encode())])
+        sent = False
+
+        async def receive_inflated():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": bytes(body), "more_body": False}
+            return await receive()
+
+        await self.app(scope, receive_inflated, send)
+
+
+class SyncFlushGzipFile(gzip.GzipFile):
+    def write(self, data):
+        written = super().write(data)
+        #zlib would hold small writes back until it has collected a block, the client gets them now.
+        self.flush(zlib.Z_SYNC_FLUSH)
+        return written
+
+
+class SyncFlushGZipResponder(GZipResponder):
+    def __init__(self, app, minimum_size, compresslevel=9):
+        super().__init__(app, minimum_size, compresslevel=compresslevel)
+        self.gzip_buffer = io.BytesIO()
+        self.gzip_file = SyncFlushGzipFile(mode="wb", fileobj=self.gzip_buffer, compresslevel=compresslevel)
+
+
+class GzipResponseMiddleware(GZipMiddleware):
+    """Starlette's GZipMiddleware, except each chunk of a streamed response (eg. /commands?stream=true,
+    /export) is sent as soon as it's written instead of once zlib's buffer fills up, so compressed
+    streams still reach the client as the database produces them."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and "gzip" in dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1"):
+            await SyncFlushGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+class MetricsMiddleware():
+    """Records every request's latency and response size under its route's path, so /commands?keyword=x
+    and /commands?keyword=y count as one, and optionally tells the client where the time went
+    with a Server-Timing header."""
+
+    def __init__(self, app, router, server_timing=False):
+        self.app = app
+        self.router = router
+        self.server_timing = server_timing
+
+    def route_of(self, scope):
+        for route in self.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        #unknown paths share a label, one per path would let anyone grow the metrics without bound.
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timing = metrics.RequestTiming()
+        token = metrics.request_timing.set(timing)
+        status = 500
+        size = 0
+
+        async def send_measured(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.server_timing:
+                    message = dict(message, headers=list(message.get("headers", [])) + [(b"server-timing", timing.server_timing().encode())])
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_measured)
+        finally:
+            metrics.request_timing.reset(token)
+            route = self.route_of(scope)
+            metrics.request_seconds.observe(perf_counter() - timing.start, scope["method"], route, status)
+            metrics.response_bytes.observe(size, scope["method"], route)
@@ -0,0 +1,105 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import perf_counter
+
+import bcrypt
+
+from app.sql.env_init import (BCRYPT_ROUNDS, PASSWORD_HASH_EXECUTOR,
+                              PASSWORD_HASH_MAX_PENDING, PASSWORD_HASH_NICE,
+                              PASSWORD_HASH_WORKERS)
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def lower_priority(nice):
+    #bcrypt releases the gil but still competes for the cpu, on linux setpriority works per thread too.
+    try:
+        if threading.current_thread() is threading.main_thread():
+            os.nice(nice)
+        else:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), os.getpriority(os.PRIO_PROCESS, 0) + nice)
+    except (AttributeError, OSError):
+        pass
+
+
+class PasswordHasher():
+    """Runs bcrypt on its own small executor so a burst of logins can't take over the threadpool
+    serving everything else, and turns requests away once max_pending of them are waiting."""
+
+    def __init__(self, workers, max_pending, rounds, kind="thread", nice=0):
+        self.workers = workers
+        self.nice = nice
+        self.max_pending = max_pending
+        self.rounds = rounds
+        self.kind = kind
+        self.executor = None
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+
+    def get_executor(self):
+        #created on first use, a process pool must not be forked along with the server workers.
+        if self.executor is None:
+            options = {"max_workers": self.workers}
+            if self.nice:
+                options.update(initializer=lower_priority, initargs=(self.nice,))
+            if self.kind == "process":
+                #spawned, forked workers would inherit the listening socket and outlive the server.
+                self.executor = ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"), **options)
+            else:
+                self.executor = ThreadPoolExecutor(**options)
+        return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, func, *args):
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HasherBusy()
+            self.pending += 1
+        start = perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.get_executor(), func, *args)
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.completed += 1
+                self.wait_total += perf_counter() - start
+
+    async def hash(self, password):
+        salt = bcrypt.gensalt(self.rounds)
+        return (await self.run(bcrypt.hashpw, password.encode("utf-8"), salt)).decode("utf-8")
+
+    async def check(self, password, hashed):
+        return await self.run(bcrypt.checkpw, password.encode("utf-8"), hashed.encode("utf-8"))
+
+    def needs_rehash(self, hashed):
+        #"$2b$<rounds>$<salt+hash>"
+        return int(hashed.split("$")[2]) != self.rounds
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "rounds": self.rounds,
+                "in_flight": min(self.pending, self.workers),
+                "queued": max(self.pending - self.workers, 0),
+                "max_pending": self.max_pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "seconds_avg": round(self.wait_total / self.completed, 6) if self.completed else 0.0,
+            }
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING, BCRYPT_ROUNDS, PASSWORD_HASH_EXECUTOR, PASSWORD_HASH_NICE)
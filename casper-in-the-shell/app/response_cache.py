@@ -0,0 +1,68 @@
+from hashlib import blake2b
+
+from fastapi import Response
+
+from app.cache import LRUCache
+from app.invalidation import WRITES, invalidations
+from app.responses import dumps
+from app.sql.env_init import RESPONSE_CACHE_BYTES, RESPONSE_CACHE_USER_ENTRIES
+
+
+def etag_of(body):
+    #weak, the same body gzipped or not is the same response as far as clients are concerned.
+    return 'W/"' + blake2b(body, digest_size=16).hexdigest() + '"'
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or etag[2:] in tags
+
+
+class ResponseCache():
+    """Encoded bodies of the read endpoints and their ETags per user, keyed by path and query
+    (without the jwt, every token of a user shares them). A user's entries are dropped whenever
+    they save something, in every worker (see invalidation.user_wrote), so whatever is cached is
+    current: a matching If-None-Match is answered with 304 and anything else with the stored body,
+    neither touching the database. Least recently used users are dropped first once the bodies
+    weigh more than RESPONSE_CACHE_BYTES altogether."""
+
+    def __init__(self, max_bytes, user_entries):
+        self.users = LRUCache(max_bytes, weight=lambda entries: sum(len(body) for _, body in entries.values()))
+        self.max_body = max_bytes // 8
+        self.user_entries = user_entries
+
+    async def respond(self, request, user_id, load):
+        #load returns the content of a 200 response, errors have to be answered before calling this.
+        invalidations.poll()
+        key = (request.url.path, tuple(sorted((name, value) for name, value in request.query_params.multi_items() if name != "jwt")))
+        entries = self.users.get(user_id)
+        cached = entries.get(key) if entries is not None else None
+        if cached is not None:
+            etag, body = cached
+        else:
+            if entries is None:
+                entries = {}
+                self.users.set(user_id, entries)
+            body = dumps(await load())
+            etag = etag_of(body)
+            #a save while loading dropped the entries, what was loaded may predate it.
+            invalidations.poll()
+            if self.users.get(user_id) is entries and len(body) <= self.max_body:
+                if len(entries) >= self.user_entries:
+                    del entries[next(iter(entries))]
+                entries[key] = (etag, body)
+                self.users.reweigh(user_id)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(body, media_type="application/json", headers={"ETag": etag})
+
+    def drop(self, user_id):
+        self.users.pop(user_id)
+
+    def clear(self):
+        self.users.clear()
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_BYTES, RESPONSE_CACHE_USER_ENTRIES)
+invalidations.subscribe(WRITES, response_cache.drop, response_cache.clear)
@@ -0,0 +1,21 @@
+import orjson
+from fastapi.responses import JSONResponse as StarletteJSONResponse
+from sqlalchemy.engine import Row
+
+
+def encode_default(value):
+    #sqlalchemy Rows are sequences but not tuples, orjson hands them here and they go out as arrays.
+    if isinstance(value, Row):
+        return tuple(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def dumps(content):
+    return orjson.dumps(content, default=encode_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class JSONResponse(StarletteJSONResponse):
+    """Drop-in for the starlette JSONResponse that encodes with orjson, the app's default response class.
+    Result rows can be passed in as they are, without copying them into lists first."""
+
+    def render(self, content):
+        return dumps(content)
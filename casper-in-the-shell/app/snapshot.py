@@ -0,0 +1,87 @@
+import zlib
+from datetime import datetime
+
+import orjson
+
+from app.responses import dumps
+from app.sql.tables import COMMAND_MAX_LENGTH
+
+#A snapshot is newline delimited json, one array per line: this header, then
+# ["m", macro id, name] and ["mc", macro id, command id, order] lines, then
+# ["c", command id, command, hits, last used, frecency] lines in id order.
+#Macros come first so a restore only has to remember the ids of the commands they refer to.
+SNAPSHOT_HEADER = ["cins-snapshot", 1]
+#The longest a command line can be, every character escaped by json as \u00XX.
+MAX_LINE_BYTES = COMMAND_MAX_LENGTH * 6 + 1024
+#Inflated bytes handled at a time, a small gzip body can't make a restore hold more than this.
+INFLATE_CHUNK = 1 << 20
+
+
+def snapshot_header():
+    return dumps(SNAPSHOT_HEADER) + b"\n"
+
+def snapshot_line(tag, row):
+    return dumps((tag, *row)) + b"\n"
+
+async def read_lines(chunks):
+    """Splits a body arriving in chunks, gzip compressed (as export sends it) or not, into lines
+    without holding more than one line and one chunk. Raises ValueError on broken gzip and on
+    lines no snapshot can have."""
+    inflater = None
+    head = b""
+    pending = b""
+    async for chunk in chunks:
+        if inflater is None and head is not None:
+            #the first two bytes tell whether it's gzip, they may arrive one at a time.
+            head += chunk
+            if len(head) < 2:
+                continue
+            chunk, head = head, None
+            if chunk[:2] == b"\x1f\x8b":
+                inflater = zlib.decompressobj(wbits=31)
+        pieces = [chunk]
+        if inflater is not None:
+            try:
+                pieces = [inflater.decompress(chunk, INFLATE_CHUNK)]
+                while inflater.unconsumed_tail:
+                    pieces.append(inflater.decompress(inflater.unconsumed_tail, INFLATE_CHUNK))
+            except zlib.error:
+                raise ValueError("Body is not valid gzip.")
+        for piece in pieces:
+            lines = (pending + piece).split(b"\n")
+            pending = lines.pop()
+            if len(pending) > MAX_LINE_BYTES:
+                raise ValueError("Line is too long to be part of a snapshot.")
+            for line in lines:
+                if line.strip():
+                    yield line
+    if inflater is not None and not inflater.eof:
+        raise ValueError("Body ends before its gzip stream does.")
+    pending = head if head is not None else pending
+    if pending.strip():
+        yield pending
+
+def check_header(line):
+    try:
+        if orjson.loads(line) == SNAPSHOT_HEADER:
+            return
+    except ValueError:
+        pass
+    raise ValueError("Body is not a cins snapshot, make one with /export.")
+
+def parse_line(line):
+    """Returns the (tag, *values) of a snapshot line, raises ValueError when it isn't one."""
+    row = orjson.loads(line)
+    if not isinstance(row, list) or not row:
+        raise ValueError("Snapshot lines have to be json arrays.")
+    tag = row[0]
+    ints = lambda values: all(isinstance(value, int) and not isinstance(value, bool) for value in values)
+    if tag == "c" and len(row) == 6 and ints(row[1:2] + row[3:4]) and isinstance(row[2], str) and isinstance(row[4], str) and isinstance(row[5], (int, float)):
+        if not row[2].strip() or len(row[2]) > COMMAND_MAX_LENGTH or row[3] < 1:
+            raise ValueError(f"Command {row[1]} is empty, too long or was never used.")
+        return tag, row[1], row[2], row[3], datetime.fromisoformat(row[4]), float(row[5])
+    if tag == "m" and len(row) == 3 and ints(row[1:2]) and isinstance(row[2], str) and 0 < len(row[2]) <= 255:
+        return tuple(row)
+    if tag == "mc" and len(row) == 4 and ints(row[1:]):
+        return tuple(row)
+    raise ValueError(f"Unknown snapshot line: {line[:100]!r}")
@@ -0,0 +1,139 @@
+import fcntl
+import logging
+import math
+
+from sqlalchemy import column, create_engine, event, func, table
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.engine import CursorResult, make_url
+from sqlalchemy.exc import OperationalError
+
+from .env_init import (FULLTEXT_NGRAM_SIZE, SQL_ASYNC, SQL_BACKEND,
+                       SQL_POOL_TIMEOUT, SQL_URL, SQLITE_CACHED_STATEMENTS,
+                       SQLITE_MMAP_BYTES)
+
+logger = logging.getLogger("cins.sql")
+
+#The statements sql_queries builds differently for MySQL and SQLite, and what an SQLite file needs set up.
+#Everything else runs the same on both, replicas have to use the primary's backend.
+SQLITE = make_url(SQL_URL).get_backend_name() == "sqlite" if SQL_URL else SQL_BACKEND == "sqlite"
+
+#trigram tokenizer, MATCH finds any substring of 3+ characters like ilike does, case insensitively.
+SQLITE_FTS_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS commands_fts USING fts5(command, content='commands', content_rowid='id', tokenize='trigram')",
+    """CREATE TRIGGER IF NOT EXISTS commands_fts_insert AFTER INSERT ON commands BEGIN
+        INSERT INTO commands_fts(rowid, command) VALUES (new.id, new.command);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS commands_fts_delete AFTER DELETE ON commands BEGIN
+        INSERT INTO commands_fts(commands_fts, rowid, command) VALUES ('delete', old.id, old.command);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS commands_fts_update AFTER UPDATE OF command ON commands BEGIN
+        INSERT INTO commands_fts(commands_fts, rowid, command) VALUES ('delete', old.id, old.command);
+        INSERT INTO commands_fts(rowid, command) VALUES (new.id, new.command);
+    END""",
+]
+commands_fts = table("commands_fts", column("rowid"), column("rank"), column("commands_fts"))
+#set by create_schema, sqlite builds without fts5 or the trigram tokenizer search by scanning.
+sqlite_fulltext = False
+
+
+def sqlite_url(path):
+    return ("sqlite+aiosqlite" if SQL_ASYNC else "sqlite") + ":///" + path
+
+def engine_options():
+    if SQLITE:
+        #timeout is how long a write waits for the one running in another connection, statements are prepared once per connection.
+        return {"connect_args": {"timeout": SQL_POOL_TIMEOUT, "cached_statements": SQLITE_CACHED_STATEMENTS}}
+    return {"isolation_level": "READ UNCOMMITTED"}
+
+def prepare_engine(engine):
+    if SQLITE:
+        event.listen(getattr(engine, "sync_engine", engine), "connect", tune_sqlite)
+
+def tune_sqlite(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    #WAL lets reads run while a write does, with it NORMAL syncs at checkpoints only and stays crash safe.
+    #foreign_keys makes macro steps pointing at missing commands fail like they do on MySQL.
+    for pragma in ("journal_mode=WAL", "synchronous=NORMAL", f"mmap_size={SQLITE_MMAP_BYTES}", "temp_store=MEMORY", "foreign_keys=ON"):
+        cursor.execute("PRAGMA " + pragma)
+    try:
+        cursor.execute("SELECT log2(1), pow(2, 1)")
+    except Exception:
+        #sqlite built without its math functions, frecency updates need these two.
+        dbapi_connection.create_function("log2", 1, math.log2, deterministic=True)
+        dbapi_connection.create_function("pow", 2, math.pow, deterministic=True)
+    cursor.close()
+
+def create_schema(url):
+    """Creates whatever tables and search index an sqlite file is missing, MySQL gets them from data/tables.sql."""
+    global sqlite_fulltext
+    from .tables import Base
+    url = make_url(url).set(drivername="sqlite")
+    if url.database in (None, "", ":memory:"):
+        raise ValueError("The sqlite backend needs a file, every pooled connection would get its own empty in-memory database.")
+    engine = create_engine(url)
+    try:
+        #workers start together, one of them creates the tables while the others wait.
+        with open(url.database + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            Base.metadata.create_all(engine)
+            with engine.begin() as conn:
+                indexed = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'commands_fts'").first() is not None
+                try:
+                    for statement in SQLITE_FTS_SCHEMA:
+                        conn.exec_driver_sql(statement)
+                    if not indexed:
+                        #commands saved before the index existed.
+                        conn.exec_driver_sql("INSERT INTO commands_fts(commands_fts) VALUES ('rebuild')")
+                    sqlite_fulltext = True
+                except OperationalError:
+                    logger.warning("This sqlite has no fts5 trigram tokenizer, keyword searches scan the user's commands.")
+    finally:
+        engine.dispose()
+
+#Isolation level of reads that mustn't see rows a save may still roll back (eg. /sync), sessions run at
+# READ UNCOMMITTED on MySQL otherwise. sqlite only ever reads committed rows.
+READ_COMMITTED = None if SQLITE else "READ COMMITTED"
+
+def insert(table):
+    return sqlite.insert(table) if SQLITE else mysql.insert(table)
+
+def upsert(table, rows, keys, update, saved_id=None):
+    """Inserts rows, a row clashing with a saved one on the unique keys updates that one instead.
+    update gets the clashing row's values (VALUES() in MySQL, excluded in SQLite) and returns the
+    (column name, value) pairs to set. With saved_id, a single row statement tells the id its row
+    was saved as or found under, read it with the saved_id function."""
+    query = insert(table).values(rows)
+    if SQLITE:
+        query = query.on_conflict_do_update(index_elements=keys, set_=dict(update(query.excluded)))
+        #sqlite leaves last_insert_rowid alone when the row existed, RETURNING tells it either way.
+        return query.returning(saved_id) if saved_id is not None and len(rows) == 1 else query
+    assignments = update(query.inserted)
+    if saved_id is not None:
+        #LAST_INSERT_ID(id) makes lastrowid point at the existing row when it was already saved.
+        assignments = [(saved_id.name, func.last_insert_id(saved_id))] + assignments
+    return query.on_duplicate_key_update(assignments)
+
+def saved_id(result):
+    #rows of a RETURNING come buffered by sqlconn.execute, not in a CursorResult anymore.
+    return result.lastrowid if isinstance(result, CursorResult) and not result.returns_rows else result.scalar_one()
+
+def greatest(*values):
+    #sqlite's max() with more than one argument is the scalar one, not the aggregate.
+    return func.max(*values) if SQLITE else func.greatest(*values)
+
+def fulltext_usable(keyword):
+    if SQLITE:
+        return sqlite_fulltext and len(keyword) >= 3
+    #ngram index can only find words at least ngram_token_size long, shorter ones fall back to the scan.
+    words = keyword.replace('"', " ").split()
+    return bool(words) and all(len(word) >= FULLTEXT_NGRAM_SIZE for word in words)
+
+def fulltext_search(query, text_column, id_column, keyword):
+    """Narrows query down to rows whose text_column contains keyword using the fulltext index,
+    returns it with the order by expression putting the best matches first."""
+    if SQLITE:
+        query = query.join(commands_fts, commands_fts.c.rowid == id_column).where(
+            commands_fts.c.commands_fts.op("MATCH")('"' + keyword.replace('"', '""') + '"'))
+        return query, commands_fts.c.rank
+    relevance = mysql.match(text_column, against='"'+keyword.replace('"', " ")+'"').in_boolean_mode()
+    return query.where(relevance), relevance.desc()
@@ -7,4 +7,91 @@ load_dotenv()
 MYSQL_USER = os.getenv("MYSQL_USER")
 MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD")
 MYSQL_DB = os.getenv("MYSQL_DB")
-JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
\ No newline at end of file
+MYSQL_HOST = os.getenv("MYSQL_HOST", "db")
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
+
+SQL_POOL_SIZE = int(os.getenv("SQL_POOL_SIZE", "10"))
+SQL_MAX_OVERFLOW = int(os.getenv("SQL_MAX_OVERFLOW", "20"))
+SQL_POOL_TIMEOUT = float(os.getenv("SQL_POOL_TIMEOUT", "10"))
+SQL_POOL_RECYCLE = int(os.getenv("SQL_POOL_RECYCLE", "1800"))
+SQL_POOL_PRE_PING = os.getenv("SQL_POOL_PRE_PING", "true").lower() == "true"
+
+SQL_ASYNC = os.getenv("SQL_ASYNC", "false").lower() == "true"
+SQL_ASYNC_DRIVER = os.getenv("SQL_ASYNC_DRIVER", "aiomysql")
+#Overrides the url built from the MYSQL_* variables, eg. sqlite+aiosqlite:///cins.db for local testing.
+SQL_URL = os.getenv("SQL_URL")
+#Has to match the server's ngram_token_size, keywords with shorter words skip the fulltext index.
+FULLTEXT_NGRAM_SIZE = int(os.getenv("FULLTEXT_NGRAM_SIZE", "2"))
+
+#Commands accepted by one /commands/bulk request, and how many are written per insert/commit.
+BULK_MAX_COMMANDS = int(os.getenv("BULK_MAX_COMMANDS", "50000"))
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+
+#Most commands returned by one /sync call, clients keep calling while "more" is true.
+SYNC_PAGE_SIZE = int(os.getenv("SYNC_PAGE_SIZE", "5000"))
+
+#Commands kept in the in-memory autocomplete indexes across all users before the least recently used are dropped.
+COMPLETE_CACHE_MAX_COMMANDS = int(os.getenv("COMPLETE_CACHE_MAX_COMMANDS", "2000000"))
+
+#Verified tokens remembered so repeated calls skip signature checks, entries also expire with the token.
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+
+#bcrypt work factor for new hashes, existing ones are rehashed on the next successful login when it changes.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+#Password hashing runs on its own "thread" or "process" pool, requests beyond max pending get a 503.
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "16"))
+#Hashing workers run at this much lower cpu priority (nice), so requests keep their share of the cpu during a login burst.
+PASSWORD_HASH_NICE = int(os.getenv("PASSWORD_HASH_NICE", "10"))
+
+#Expanded macros and macro name lists kept in memory across all users, dropped per user when they save a macro.
+MACRO_CACHE_SIZE = int(os.getenv("MACRO_CACHE_SIZE", "100000"))
+
+#Largest request body accepted once a gzip Content-Encoding is inflated.
+REQUEST_MAX_BYTES = int(os.getenv("REQUEST_MAX_BYTES", "67108864"))
+#Saves and searches accepted in one /batch request.
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "500"))
+#Responses at least this big are gzip compressed for clients accepting it.
+RESPONSE_GZIP_MIN_BYTES = int(os.getenv("RESPONSE_GZIP_MIN_BYTES", "1024"))
+
+#Statements taking at least this many milliseconds are logged (cins.slow_query logger) without their parameters, 0 turns the log off.
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0"))
+#Adds a Server-Timing header (database time, query count, total) to every response.
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() == "true"
+#Request, query and pool metrics on /metrics in the prometheus text format, and the /stats endpoints. Off by default, they show server internals.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+#When set, those endpoints also want an "Authorization: Bearer <METRICS_TOKEN>" header.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+#Memory mapped file the server workers on one host share cache invalidations through, empty turns it off (eg. for a single worker).
+#Unset, each deployment gets its own in a directory private to the user, see invalidation.default_path.
+CACHE_INVALIDATION_FILE = os.getenv("CACHE_INVALIDATION_FILE")
+#Invalidations kept in the file, a worker that falls further behind clears its caches.
+CACHE_INVALIDATION_SLOTS = int(os.getenv("CACHE_INVALIDATION_SLOTS", "65536"))
+#Connections each worker opens at startup so the first requests don't pay for them.
+SQL_POOL_WARM = int(os.getenv("SQL_POOL_WARM", str(SQL_POOL_SIZE)))
+
+#Read replicas, either full urls or hosts sharing the MYSQL_* credentials (comma separated). Read only handlers use them.
+SQL_REPLICA_URLS = [url for url in os.getenv("SQL_REPLICA_URLS", "").split(",") if url]
+MYSQL_REPLICA_HOSTS = [host for host in os.getenv("MYSQL_REPLICA_HOSTS", "").split(",") if host]
+#After a user saves something their reads go to the primary for this long, so they see their write despite replication lag.
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "10"))
+#Recent writers each worker remembers for that, the least recently written drop out first and may read from a replica again.
+REPLICA_STICKY_USERS = int(os.getenv("REPLICA_STICKY_USERS", "100000"))
+#A replica that failed to answer is skipped this long before it is tried again.
+REPLICA_RETRY_SECONDS = float(os.getenv("REPLICA_RETRY_SECONDS", "30"))
+
+#Encoded read responses kept for ETag/304 answers, in bytes altogether and per user (distinct queries).
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", "67108864"))
+RESPONSE_CACHE_USER_ENTRIES = int(os.getenv("RESPONSE_CACHE_USER_ENTRIES", "64"))
+
+#How often each worker checks the invalidation log for saves made in other workers while /ws/sync clients are connected.
+LIVE_SYNC_POLL_SECONDS = float(os.getenv("LIVE_SYNC_POLL_SECONDS", "0.1"))
+
+#"mysql", or "sqlite" to keep everything in the SQLITE_PATH file instead of a MySQL server. SQL_URL takes precedence, its scheme picks the backend then.
+SQL_BACKEND = os.getenv("SQL_BACKEND", "mysql").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "cins.db")
+#Bytes of the sqlite file read through a memory map instead of read() calls, and prepared statements kept per connection.
+SQLITE_MMAP_BYTES = int(os.getenv("SQLITE_MMAP_BYTES", "268435456"))
+SQLITE_CACHED_STATEMENTS = int(os.getenv("SQLITE_CACHED_STATEMENTS", "256"))
\ No newline at end of file
@@ -0,0 +1,101 @@
+import logging
+from threading import Lock
+from time import perf_counter
+
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger("cins.sql")
+
+
+class PoolStats():
+    """Counters for connection checkouts, shared by every metered pool in the process."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.checkouts = 0
+        self.checkins = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_checkout(self, waited, timed_out=False):
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += waited
+            if waited > self.wait_max:
+                self.wait_max = waited
+
+    def record_checkin(self):
+        with self.lock:
+            self.checkins += 1
+
+    def snapshot(self, pool):
+        with self.lock:
+            return {
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+                "checked_in": pool.checkedin(),
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": round(self.wait_total, 6),
+                "wait_seconds_max": round(self.wait_max, 6),
+                "wait_seconds_avg": round(self.wait_total / self.checkouts, 6) if self.checkouts else 0.0,
+            }
+
+
+pool_stats = PoolStats()
+
+
+class MeteredPoolMixin():
+    #Records how long callers wait to get a connection out of the pool.
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            conn = super()._do_get()
+        except Exception:
+            pool_stats.record_checkout(perf_counter() - start, timed_out=True)
+            raise
+        pool_stats.record_checkout(perf_counter() - start)
+        return conn
+
+    def _do_return_conn(self, record):
+        pool_stats.record_checkin()
+        return super()._do_return_conn(record)
+
+
+class MeteredQueuePool(MeteredPoolMixin, QueuePool):
+    pass
+
+
+class MeteredAsyncQueuePool(MeteredPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+async def warm_pool(engine, count):
+    """Opens count connections (at most the pool size, overflow ones would be closed again) and
+    hands them back, so a freshly started worker doesn't connect on its first requests."""
+    count = min(count, engine.pool.size())
+    connections = []
+    try:
+        if isinstance(engine, AsyncEngine):
+            for _ in range(count):
+                connections.append(await engine.connect())
+            for connection in connections:
+                await connection.close()
+        else:
+            def connect_all():
+                for _ in range(count):
+                    connections.append(engine.connect())
+                for connection in connections:
+                    connection.close()
+            await run_in_threadpool(connect_all)
+    except Exception:
+        #the database may come up after the api, requests connect on demand then.
+        logger.warning("Couldn't warm the connection pool, %d of %d connections opened.", len(connections), count, exc_info=True)
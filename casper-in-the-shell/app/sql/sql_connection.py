@@ -1,50 +1,257 @@
+import logging
+from itertools import count
+from time import monotonic
+
+from fastapi import Depends
+from sqlalchemy.engine import CursorResult
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from ..cache import LRUCache
+from ..invalidation import WRITES, invalidations
+from ..main import replica_engines, sql_engine
+from ..metrics import record_rows
+from ..utils import require_auth
+from .backend import READ_COMMITTED, SQLITE
+from .env_init import (REPLICA_RETRY_SECONDS, REPLICA_STICKY_SECONDS,
+                       REPLICA_STICKY_USERS, SQL_ASYNC)
+from .sql_queries import Select
+
+STREAM_CHUNK_SIZE = 500
+
+logger = logging.getLogger("cins.sql")
+
+
+class ReplicaRouter():
+    """Picks the engine read only requests run on: the replicas in turn, skipping ones that failed
+    in the last REPLICA_RETRY_SECONDS, or the primary when there are none left or the user saved
+    something in the last REPLICA_STICKY_SECONDS (a replica may not have their write yet).
+    Saves reach it through invalidation.user_wrote, from every worker, so stickiness holds
+    whichever worker the next request lands on."""
+
+    def __init__(self, primary, replicas, sticky_seconds, sticky_users, retry_seconds):
+        self.primary = primary
+        self.replicas = replicas
+        self.sticky_seconds = sticky_seconds
+        self.retry_seconds = retry_seconds
+        self.turn = count()
+        self.down_until = {}
+        #user_id -> when they last wrote, as far as this worker knows.
+        self.writes = LRUCache(sticky_users)
+        self.everyone_until = 0
+        invalidations.subscribe(WRITES, self.mark_write, self.lost_writes)
+
+    def engine_for(self, user_id=None):
+        if not self.replicas:
+            return self.primary
+        now = monotonic()
+        if user_id is not None:
+            invalidations.poll()
+            wrote = self.writes.get(user_id)
+            if wrote is not None and now - wrote < self.sticky_seconds or now < self.everyone_until:
+                return self.primary
+        for _ in range(len(self.replicas)):
+            engine = self.replicas[next(self.turn) % len(self.replicas)]
+            if self.down_until.get(engine, 0) <= now:
+                return engine
+        return self.primary
+
+    def mark_write(self, user_id):
+        self.writes.set(user_id, monotonic())
+
+    def lost_writes(self):
+        #this worker missed some announcements, everyone is sent to the primary until they are out of date anyway.
+        self.writes.clear()
+        self.everyone_until = monotonic() + self.sticky_seconds
+
+    def failed(self, engine):
+        logger.warning("Replica %s didn't answer, reading from the primary for %ss.", engine.url.host or engine.url, self.retry_seconds)
+        self.down_until[engine] = monotonic() + self.retry_seconds
+
 
-from ..main import sql_engine
+replicas = ReplicaRouter(sql_engine, replica_engines, REPLICA_STICKY_SECONDS, REPLICA_STICKY_USERS, REPLICA_RETRY_SECONDS)
+#READ COMMITTED copies of the engines, sharing their pools. A connection goes back at the engine's own level.
+committed_engines = {}
+
+def committed(engine):
+    if READ_COMMITTED is None:
+        return engine
+    if engine not in committed_engines:
+        committed_engines[engine] = engine.execution_options(isolation_level=READ_COMMITTED)
+    return committed_engines[engine]
 
 
 class sqlconn:
+    #One Session per request, the pooled connection is only checked out on first use
+    #and handed back to the pool on close. Blocking driver calls are run in the threadpool
+    #so handlers can stay async in both modes. Read only ones may be on a replica, see ReplicaRouter.
+    def __init__(self, engine=sql_engine, read_committed=False):
+        self.engine = engine
+        self.read_committed = read_committed
+        self.session = self.new_session()
+
+    def bind(self):
+        return committed(self.engine) if self.read_committed else self.engine
+
+    def new_session(self):
+        return Session(self.bind())
 
-    def __init__(self):
-        self.init_call()
+    async def read(self, run):
+        #A replica that can't be reached is taken out of rotation and run is repeated on the primary.
+        try:
+            return await run()
+        except (OperationalError, DBAPIError) as e:
+            if self.engine is sql_engine or not (isinstance(e, OperationalError) or e.connection_invalidated):
+                raise
+            replicas.failed(self.engine)
+            await self.close()
+            self.engine = sql_engine
+            self.session = self.new_session()
+            return await run()
 
-    def __enter__(self):
-        self.init_call()
+    async def __aenter__(self):
         return self
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.close()
-
-    def init_call(self):
-        engine = sql_engine
-        connection = engine.connect()
-        connection = connection.execution_options(
-        stream_results=True,
-        isolation_level="READ UNCOMMITTED"
-)
-        self.session = Session(engine)
-        self.connection = connection
-        
-    def execute(self,query):
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def all(self,query):
+        return record_rows(query, await self.read(lambda: run_in_threadpool(lambda: self.session.execute(query).fetchall())))
+
+    async def scalars(self,query):
+        return record_rows(query, await self.read(lambda: run_in_threadpool(lambda: self.session.execute(query).scalars().all())))
+
+    async def stream(self,query,size=STREAM_CHUNK_SIZE):
+        #Server side cursor, rows are yielded in chunks as the database sends them.
+        result = await self.read(lambda: run_in_threadpool(self.session.execute,query.execution_options(stream_results=True,yield_per=size)))
+        partitions = result.partitions(size)
+        while True:
+            rows = await run_in_threadpool(next,partitions,None)
+            if rows is None:
+                break
+            yield record_rows(query, rows)
+
+    async def execute(self,query):
+        #Returns the result (eg. for lastrowid) or False when the query failed.
+        try:
+            return await run_in_threadpool(self.execute_buffered,query)
+        except Exception:
+            #counted in cins_sql_errors_total by the engine hooks, the statement is logged without its parameters.
+            logger.exception("Error in sql query execution. query was: %s", query)
+            return False
+
+    def execute_buffered(self,query):
+        #rows of eg. an INSERT .. RETURNING are read right away, sqlite can't commit while a statement has some left.
+        result = self.session.execute(query)
+        return result if isinstance(result, CursorResult) and not result.returns_rows else result.freeze()()
+
+    async def lock_user(self,user_id):
+        #A user's saves wait for each other from here to their commit, so their rows commit in id order
+        # and a /sync that sees an id has seen every smaller one. sqlite runs one write at a time anyway.
+        if SQLITE:
+            return True
+        return bool(await self.execute(Select.user_lock({"user_id":user_id})))
+
+    def add(self,instance):
+        self.session.add(instance)
+
+    async def flush(self):
+        await run_in_threadpool(self.session.flush)
+    
+    async def commit(self):
         try:
-            self.session.execute(query)
+            await run_in_threadpool(self.session.commit)
             return True
-        except Exception as e:
-            print(e)
-            print("Error in sql query execution. query was:  " + str(query))
+        except Exception:
+            logger.exception("Error while committing to the database.")
+            #the session is usable again afterwards, eg. for the next transaction of an import.
+            try:
+                await self.rollback()
+            except Exception:
+                logger.exception("Error while rolling back a failed commit.")
             return False
+
+    async def rollback(self):
+        await run_in_threadpool(self.session.rollback)
+
+    async def close(self):
+        try:
+            await run_in_threadpool(self.session.close)
+        except Exception:
+            logger.exception("Error while closing the database session.")
+
+
+class asqlconn(sqlconn):
+    #Same interface as sqlconn, backed by an AsyncSession on the async engine.
+    def new_session(self):
+        return AsyncSession(self.bind())
+
+    async def all(self,query):
+        return record_rows(query, (await self.read(lambda: self.session.execute(query))).fetchall())
+
+    async def scalars(self,query):
+        return record_rows(query, (await self.read(lambda: self.session.execute(query))).scalars().all())
+
+    async def stream(self,query,size=STREAM_CHUNK_SIZE):
+        result = await self.read(lambda: self.session.stream(query.execution_options(yield_per=size)))
+        async for rows in result.partitions(size):
+            yield record_rows(query, rows)
+
+    async def execute(self,query):
+        try:
+            return await self.session.execute(query)
+        except Exception:
+            #counted in cins_sql_errors_total by the engine hooks, the statement is logged without its parameters.
+            logger.exception("Error in sql query execution. query was: %s", query)
+            return False
+
+    async def flush(self):
+        await self.session.flush()
     
-    def commit(self):
+    async def commit(self):
         try:
-            self.session.commit()
+            await self.session.commit()
             return True
-        except:
-            print("Error while committing to the database.")
+        except Exception:
+            logger.exception("Error while committing to the database.")
+            #the session is usable again afterwards, eg. for the next transaction of an import.
+            try:
+                await self.rollback()
+            except Exception:
+                logger.exception("Error while rolling back a failed commit.")
             return False
 
-    def close(self):
+    async def rollback(self):
+        await self.session.rollback()
+
+    async def close(self):
         try:
-            self.session.invalidate()
-            self.connection.close()
-        except:
-            print("error closing connections")
\ No newline at end of file
+            await self.session.close()
+        except Exception:
+            logger.exception("Error while closing the database session.")
+
+def connect(read_only=False, user_id=None, read_committed=False):
+    #read_only sessions must not write, they may be on a replica.
+    engine = replicas.engine_for(user_id) if read_only else sql_engine
+    return asqlconn(engine, read_committed) if SQL_ASYNC else sqlconn(engine, read_committed)
+
+async def get_sql():
+    async with connect() as sql:
+        yield sql
+
+async def get_read_sql(auth: dict = Depends(require_auth)):
+    #For handlers that only read the user's data, the user's recent saves keep them on the primary.
+    async with connect(read_only=True, user_id=auth["user"]) as sql:
+        yield sql
+
+async def get_committed_read_sql(auth: dict = Depends(require_auth)):
+    #Like get_read_sql, without seeing saves that aren't committed yet, eg. for /sync's watermark.
+    async with connect(read_only=True, user_id=auth["user"], read_committed=True) as sql:
+        yield sql
+
+async def get_replica_sql():
+    #Read only and not tied to a user, eg. login.
+    async with connect(read_only=True) as sql:
+        yield sql
\ No newline at end of file
@@ -1,46 +1,132 @@
+from datetime import datetime
+from functools import wraps
+
 from sqlalchemy import (delete, desc, exists, func, literal, not_, select,
                         update)
-from sqlalchemy.dialects.mysql import insert
 from sqlalchemy.orm import aliased
+from sqlalchemy.sql.base import Executable
 from sqlalchemy.sql.functions import coalesce, concat, count
 
+from app.sql.backend import (fulltext_search, fulltext_usable, greatest,
+                             upsert)
 from app.sql.tables import *
+from app.utils import command_hash, frecency_now
+
 
+def named(cls):
+    #Tags every statement a builder returns with its name (eg. "Select.command"), app.metrics reports query timings by it.
+    def tag(name, build):
+        @wraps(build)
+        def tagged(*args, **kwargs):
+            result = build(*args, **kwargs)
+            return result.execution_options(builder=name) if isinstance(result, Executable) else result
+        return tagged
+    for name, build in list(vars(cls).items()):
+        if callable(build):
+            setattr(cls, name, tag(f"{cls.__name__}.{name}", build))
+    return cls
 
+
+@named
 class Select():
     def user(data):
         return select(User).where(User.username == data["username"])
+
+    def user_lock(data):
+        return select(User.id).where(User.id == data["user_id"]).with_for_update()
     
     def command(data):
-        query = select(Command.command).where(Command.user_id == data["user_id"]).order_by(Command.id.desc())
-        if "include_ids" in data:
-            query = select(Command.id,Command.command).where(Command.user_id == data["user_id"]).order_by(Command.id.desc())
+        query = select(Command.id,Command.command).where(Command.user_id == data["user_id"]).order_by(Command.id.desc())
+        #keyset pagination, after_id walks forward from the oldest so it is returned in id order.
+        if "before_id" in data:
+            query = query.where(Command.id < data["before_id"])
+        if "after_id" in data:
+            query = query.where(Command.id > data["after_id"]).order_by(None).order_by(Command.id)
         if "keyword" in data:
             query = query.where(Command.command.ilike("%"+data["keyword"]+"%"))
+            if Select.fulltext_usable(data["keyword"]):
+                #the fulltext index narrows rows down, ilike above still checks for the exact substring.
+                query, best_first = fulltext_search(query, Command.command, Command.id, data["keyword"])
+                if data.get("sort") == "relevance":
+                    query = query.order_by(None).order_by(best_first, Command.id.desc())
+        if data.get("sort") == "frecency":
+            query = query.order_by(None).order_by(Command.frecency.desc(), Command.id.desc())
         if "limit" in data:
             query = query.limit(data["limit"])
         return query
     
+    def command_ranks(data):
+        return select(Command.id,Command.command,Command.frecency).where(Command.user_id == data["user_id"])
+
+    def fulltext_usable(keyword):
+        #keywords the index can't find (eg. too short ones) fall back to the scan, see backend.fulltext_usable.
+        return fulltext_usable(keyword)
+
     def macro(data):
-        subquery = None
+        #one join, the unique user_id_name key finds the macro and the macro_commands primary key keeps the order.
         if "name" in data:
-            subquery = select(Macro.id).where(Macro.user_id == data["user_id"], Macro.name == data["name"]).subquery()
+            macro_filter = (Macro.user_id == data["user_id"], Macro.name == data["name"])
         else:
-            subquery = select(Macro.id).where(Macro.user_id == data["user_id"]).order_by(Macro.id.desc()).limit(1).subquery()
-        command_ids_subquery = select(MacroCommand.command_id,MacroCommand.order).where(MacroCommand.macro_id.in_(subquery)).order_by(MacroCommand.order)
-        return select(Command.command).where(Command.id == command_ids_subquery.c.command_id).order_by(command_ids_subquery.c.order)
-    
-    def macro_exists(data):
-        return select(Macro.id).where(Macro.user_id == data["user_id"], Macro.name == data["name"])
+            latest = select(func.max(Macro.id)).where(Macro.user_id == data["user_id"]).scalar_subquery()
+            macro_filter = (Macro.id == latest,)
+        return select(Command.command).select_from(Macro).join(MacroCommand, MacroCommand.macro_id == Macro.id).join(
+            Command, Command.id == MacroCommand.command_id).where(*macro_filter).order_by(MacroCommand.order)
     
     def macros(data):
         return select(Macro.name).where(Macro.user_id == data["user_id"])
+
+    def macros_since(data):
+        return select(Macro.id,Macro.name).where(Macro.user_id == data["user_id"], Macro.id > data["after_id"]).order_by(Macro.id)
+
+    def macro_commands(data):
+        return select(MacroCommand.macro_id,Command.command).join(Command, Command.id == MacroCommand.command_id).where(
+            MacroCommand.macro_id.in_(data["macro_ids"])).order_by(MacroCommand.macro_id,MacroCommand.order)
+
+    def command_ids(data):
+        #ids of the user's commands by their hash, eg. to find what the rows of an upsert ended up as.
+        return select(Command.command_hash,Command.id).where(Command.user_id == data["user_id"], Command.command_hash.in_(data["hashes"]))
+
+    def export_commands(data):
+        return select(Command.id,Command.command,Command.hits,Command.last_used,Command.frecency).where(
+            Command.user_id == data["user_id"]).order_by(Command.id)
+
+    def export_macro_commands(data):
+        return select(MacroCommand.macro_id,MacroCommand.command_id,MacroCommand.order).join(Macro, Macro.id == MacroCommand.macro_id).where(
+            Macro.user_id == data["user_id"]).order_by(MacroCommand.macro_id,MacroCommand.order)
     
+def frecency_sum(saved, added):
+    #log2(2^saved + 2^added) without overflowing pow, see utils.frecency_add.
+    return greatest(saved, added) + func.log2(1 + func.pow(2, -func.abs(saved - added)))
+
+@named
+class Update():
+    def user_password(data):
+        return update(User).where(User.id == data["user_id"]).values(password = data["password"])
+
+@named
 class Insert():
     def command(data):
-        #using on_duplicate_key_update prevents headaches about unique constraint exceptions, 
-        # we just update id with its original value as fallback.
-        return insert(Command).values(data).on_duplicate_key_update(id = Command.id)
+        #upserting prevents headaches about unique constraint exceptions (on user_command_hash),
+        # a single saved command tells its id either way (see backend.saved_id).
+        # Saving it again counts as a use, frecency becomes log2(2^frecency + 2^now) (see utils.frecency_add).
+        now = datetime.now()
+        score = frecency_now()
+        rows = [dict(row, command_hash=command_hash(row["command"]), last_used=now, frecency=score)
+                for row in (data if isinstance(data, list) else [data])]
+        return upsert(Command, rows, ["user_id", "command_hash"], lambda new: [
+            ("hits", Command.hits + 1),
+            ("frecency", frecency_sum(Command.frecency, new.frecency)),
+            ("last_used", new.last_used),
+        ], saved_id=Command.id)
+
+    def restored_command(data):
+        #rows of a snapshot keep their hits, last use and frecency, a command that is already saved adds them to its own.
+        rows = [dict(row, command_hash=command_hash(row["command"])) for row in data]
+        return upsert(Command, rows, ["user_id", "command_hash"], lambda new: [
+            ("hits", Command.hits + new.hits),
+            ("frecency", frecency_sum(Command.frecency, new.frecency)),
+            ("last_used", greatest(Command.last_used, new.last_used)),
+        ])
     
     def macro_command(data):
-        return insert(MacroCommand).values(data).on_duplicate_key_update(macro_id = MacroCommand.macro_id)
\ No newline at end of file
+        return upsert(MacroCommand, data, ["macro_id", "order"], lambda new: [("macro_id", MacroCommand.macro_id)])
\ No newline at end of file
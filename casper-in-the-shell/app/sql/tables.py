@@ -1,9 +1,12 @@
-from sqlalchemy import (DECIMAL, Column, DateTime, ForeignKey, Integer, String,
-                        Text)
+from sqlalchemy import (BINARY, DECIMAL, Column, DateTime, Double, ForeignKey,
+                        Index, Integer, String, Text, UniqueConstraint, func)
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
 
+#TEXT holds 65535 bytes, a utf8mb4 character takes up to 4 of them.
+COMMAND_MAX_LENGTH = 16383
+
 class User(Base):
     __tablename__ = 'users'
 
@@ -16,7 +19,21 @@ class Command(Base):
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
-    command = Column(String(511), nullable=False)
+    command = Column(Text, nullable=False)
+    #first 8 bytes of the command's sha256 (utils.command_hash), carries the per user uniqueness
+    # instead of a wide index over the text itself.
+    command_hash = Column(BINARY(8), nullable=False)
+    hits = Column(Integer, nullable=False, server_default="1")
+    last_used = Column(DateTime, nullable=False, server_default=func.now())
+    frecency = Column(Double, nullable=False, server_default="0")
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "command_hash", name="user_command_hash"),
+        Index("user_recent", "user_id", "id"),
+        #sqlite searches through its fts5 table instead, see backend.SQLITE_FTS_SCHEMA.
+        Index("command_fulltext", "command", mysql_prefix="FULLTEXT", mysql_with_parser="ngram").ddl_if(dialect="mysql"),
+        Index("user_frecency", "user_id", "frecency"),
+    )
 
 class Macro(Base):
     __tablename__ = 'macros'
@@ -25,9 +42,14 @@ class Macro(Base):
     user_id = Column(Integer, nullable=False)
     name = Column(String(255), nullable=False)
 
+    __table_args__ = (
+        UniqueConstraint("user_id", "name", name="user_id_name"),
+    )
+
 class MacroCommand(Base):
     __tablename__ = 'macro_commands'
 
-    macro_id = Column(Integer, primary_key=True)
-    command_id = Column(Integer, primary_key=True)
-    order = Column(Integer, nullable=False)
\ No newline at end of file
+    #same keys as data/tables.sql, a command can be a step of the macro more than once.
+    macro_id = Column(Integer, ForeignKey("macros.id", ondelete="CASCADE"), primary_key=True)
+    command_id = Column(Integer, ForeignKey("commands.id", ondelete="CASCADE"), nullable=False)
+    order = Column(Integer, primary_key=True)
\ No newline at end of file
@@ -1,36 +1,116 @@
+import hashlib
+import json
+import math
+import time
 from datetime import datetime
 
 import jwt
+from fastapi import HTTPException, Query
 
-from .sql.env_init import JWT_SECRET_KEY
+from .cache import LRUCache
+from .sql.env_init import AUTH_CACHE_SIZE, JWT_SECRET_KEY
+
+#verified tokens by sha256 of the token, so raw tokens aren't kept around in memory.
+token_cache = LRUCache(AUTH_CACHE_SIZE)
 
 
 def decode_jwt_token(encoded_content):
     try:
-        decoded_content = jwt.decode(encoded_content, JWT_SECRET_KEY, ["HS256"])
+        decoded_content = jwt.decode(encoded_content, JWT_SECRET_KEY, ["HS256"], options={"require": ["exp"]})
+    except jwt.MissingRequiredClaimError:
+        #tokens issued before the exp claim carry "expire_at" instead.
+        decoded_content = decode_legacy_jwt_token(encoded_content)
     except:
         decoded_content = False
     return decoded_content
 
+def decode_legacy_jwt_token(encoded_content):
+    try:
+        decoded_content = jwt.decode(encoded_content, JWT_SECRET_KEY, ["HS256"])
+        expire_at = datetime.strptime(decoded_content.pop("expire_at"),"%Y-%m-%d %H:%M:%S.%f")
+    except:
+        return False
+    decoded_content["exp"] = expire_at.timestamp()
+    return decoded_content if time.time() < decoded_content["exp"] else False
+
 def generate_jwt_token(content):
     encoded_content = jwt.encode(content, JWT_SECRET_KEY, algorithm="HS256")
     token = str(encoded_content)
     return token
 
 def check_auth(token):
-    test = decode_jwt_token(token)
-    if test:
-        if not set(["expire_at", "user"]) == set(test.keys()):
+    key = hashlib.sha256(token.encode("utf-8")).digest()
+    auth = token_cache.get(key)
+    if auth is None:
+        auth = decode_jwt_token(token)
+        if not auth or set(auth) != {"exp", "user"}:
             return None
-        if datetime.now() < datetime.strptime(test["expire_at"],"%Y-%m-%d %H:%M:%S.%f"):
-            return test
-    return None
-
-def listify(map):
-    templist = []
-    for row in map:
-        listx = []
-        for val in row:
-            listx.append(val)
-        templist.append(listx)
-    return templist
\ No newline at end of file
+        token_cache.set(key, auth)
+    if time.time() >= auth["exp"]:
+        token_cache.pop(key)
+        return None
+    return auth
+
+async def require_auth(jwt: str = Query(description="Jwt used for auth.")):
+    #Shared dependency of the authenticated endpoints, answers 401 for missing/expired/wrong tokens.
+    auth = check_auth(jwt)
+    if not auth:
+        raise HTTPException(status_code=401, detail="Can't get the user because token is expired or wrong.")
+    return auth
+
+def parse_commands(body, content_type=""):
+    #Accepts a json array of commands, {"commands": [...]}, or ndjson with one command
+    #(or {"command": ...}) per line. Raises ValueError on anything else.
+    text = body.decode("utf-8")
+    if "ndjson" in content_type:
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        items = json.loads(text)
+        if isinstance(items, dict):
+            items = items.get("commands")
+    if not isinstance(items, list):
+        raise ValueError("Expected a list of commands.")
+    commands = []
+    for item in items:
+        if isinstance(item, dict):
+            item = item.get("command")
+        if not isinstance(item, str):
+            raise ValueError("Commands have to be strings.")
+        commands.append(item)
+    return commands
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def parse_watermark(watermark):
+    #"<last command id>.<last macro id>", empty means from the beginning.
+    if not watermark:
+        return 0, 0
+    command_id, macro_id = watermark.split(".")
+    command_id, macro_id = int(command_id), int(macro_id)
+    if command_id < 0 or macro_id < 0:
+        raise ValueError("Watermark ids can't be negative.")
+    return command_id, macro_id
+
+def format_watermark(command_id, macro_id):
+    return f"{command_id}.{macro_id}"
+
+def command_hash(command):
+    #64 bits of sha256, a collision within one user's history is vanishingly unlikely (about 1 in 10^7 at a million commands).
+    return hashlib.sha256(command.encode("utf-8")).digest()[:8]
+
+#Frecency is stored as log2 of the sum of 2^(t / FRECENCY_HALF_LIFE) over every use of a command, t counted
+#from FRECENCY_EPOCH. Every use is worth half as much one half life later, yet the stored value never has
+#to be decayed so it can be indexed. Changing these two invalidates every stored score.
+FRECENCY_EPOCH = 1704067200
+FRECENCY_HALF_LIFE = 7 * 24 * 3600
+
+def frecency_now(timestamp=None):
+    return ((timestamp or time.time()) - FRECENCY_EPOCH) / FRECENCY_HALF_LIFE
+
+def frecency_add(score, use):
+    #log2(2^score + 2^use) without overflowing.
+    if score is None:
+        return use
+    return max(score, use) + math.log2(1 + 2 ** -abs(score - use))
\ No newline at end of file
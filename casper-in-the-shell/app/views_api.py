@@ -1,15 +1,21 @@
-from datetime import datetime, timedelta
+import hmac
+from datetime import datetime, timedelta, timezone
 from html import escape
 
-import bcrypt
-from fastapi import Form, Query, Request
+from fastapi import Depends, Form, Header, HTTPException, Query, Request
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 
-from app.main import app
-from app.sql.sql_connection import sqlconn
-from app.sql.sql_queries import Select
+from app import metrics
+from app.invalidation import invalidations
+from app.main import app, replica_engines, sql_engine
+from app.passwords import HasherBusy, password_hasher
+from app.responses import JSONResponse
+from app.sql.sql_connection import connect, get_replica_sql, get_sql, sqlconn
+from app.sql.env_init import METRICS_ENABLED, METRICS_TOKEN, SQL_POOL_WARM
+from app.sql.pool import pool_stats, warm_pool
+from app.sql.sql_queries import Select, Update
 from app.sql.tables import User
 from app.utils import generate_jwt_token
 
@@ -48,6 +54,7 @@ def help():
         HTML 200: {"msg":"jwt"}
         HTML 422: Json message about the error (Username and password needs to be between certain lengths, or they are not supplied, or they are not strings.)
         HTML 400: {"detail": "Credentials are invalid."}
+        HTML 503: {"detail": "Too many logins at once, try again in a moment."}
 
     /register POST:
         Example Usage:
@@ -60,16 +67,26 @@ def help():
     /commands GET:
         Example Usage:
         curl -X GET http://localhost:8002/api/commands?keyword={kw_string}&limit={integer}&include_ids={boolean}&jwt={jwt}
+        curl -X GET http://localhost:8002/api/commands?limit=100&before_id={next_cursor}&jwt={jwt}
+        curl -N -X GET http://localhost:8002/api/commands?stream=true&jwt={jwt}
 
         Returns the commands matching query, in LIFO order. Latest command is returned first.
+        When a keyword is given, commands are ranked by how well they match it and then by recency.
+        sort=recent returns them newest first, sort=frecency returns the most used, most recently used commands first,
+          so a small limit returns the most relevant ones.
         keyword can be empty but it needs to be included as a query,
         limit defines the returned command count, not including or setting it to 0 returns all findings.
         include_ids sets the format data is returned, not including or setting to false returns command strings as an array,
           while setting it to true returns array of [id,command_string] which is useful for setting up macros. 
+        before_id and after_id page through the commands by id, when a page is full the response carries a next_cursor,
+          pass it as before_id (or after_id when paging forward, which returns oldest first) to get the next page.
+          Keyword matches ranked by relevance have no cursor, add sort=recent to page through them.
+        stream set to true returns the commands as newline delimited json (one [command] or [id,command] per line)
+          as they are read from the database, instead of a single json document.
         jwt is the jwt key returned from /login endpoint.
 
         Returns response JSON:
-        HTML 200: {"msg":"["command2","command1"]"} or if include_ids set to True {"msg":"[[5,"command2"],[3,"command1"]]"}
+        HTML 200: {"msg":"["command2","command1"]","next_cursor":null} or if include_ids set to True {"msg":"[[5,"command2"],[3,"command1"]]","next_cursor":null}
         HTML 422: Json message about the error
         HTML 401: {"detail": "Show unauthorized message(Jwt doesn't exist, or expired.)"}
 
@@ -86,6 +103,103 @@ def help():
         HTML 400: {"detail": "Bad request, command is empty or just whitespaces."}
         HTML 401: {"detail": "Show unauthorized message(Jwt doesn't exist, or expired.)"}
 
+    /commands/bulk POST:
+        Example Usage:
+        curl -X POST http://localhost:8002/api/commands/bulk?jwt={jwt} -H 'Content-Type: application/json' -d '["command1","command2"]'
+        curl -X POST http://localhost:8002/api/commands/bulk?jwt={jwt} -H 'Content-Type: application/x-ndjson' --data-binary @commands.ndjson
+
+        Saves many commands at once, body is a json array of commands (or {"commands": [...]}),
+        or with the ndjson content type one json string (or {"command": ...}) per line.
+        Empty, too long and repeated commands are skipped, the rest is written in batches.
+        jwt is the jwt key returned from /login endpoint.
+
+        Returns response JSON:
+        HTML 200: {"msg":{"received":3,"saved":2,"skipped":1}}
+        HTML 400: {"detail": "Body has to be a json array or ndjson stream of commands."}
+        HTML 401: {"detail": "Show unauthorized message(Jwt doesn't exist, or expired.)"}
+
+    /batch POST:
+        Example Usage:
+        curl -X POST http://localhost:8002/api/batch?jwt={jwt} -H 'Content-Type: application/json' -d '{"requests":[{"op":"save","command":"ls -la"},{"op":"search","keyword":"ls","limit":5}]}'
+
+        Runs several saves and searches in one request, in the given order, a search sees the saves before it.
+        A save takes command, a search takes the /commands GET parameters (keyword, limit, include_ids, before_id, after_id, sort).
+        Results come back in the same order, a request that failed has a detail and status_code instead of msg.
+        Saves are written together, if they can't be the whole batch fails and nothing is saved.
+        jwt is the jwt key returned from /login endpoint.
+
+        Returns response JSON:
+        HTML 200: {"msg":[{"msg":"I managed to save your command. ls -la"},{"msg":[["ls -la"]],"next_cursor":null}]}
+        HTML 422: Json message about the error
+        HTML 401: {"detail": "Show unauthorized message(Jwt doesn't exist, or expired.)"}
+        HTML 500: {"detail": "Couldn't save your commands, try again later."}
+
+    Request bodies can be sent gzip compressed with a 'Content-Encoding: gzip' header,
+    responses over 1KB are gzip compressed for clients sending 'Accept-Encoding: gzip'.
+
+    /complete GET:
+        Example Usage:
+        curl -X GET http://localhost:8002/api/complete?prefix={prefix}&limit={integer}&jwt={jwt}
+
+        Returns up to limit (default 10, at most 100) saved commands that start with prefix, most frecent
+        (often and recently saved) first.
+        Meant to be called on every keystroke, it is answered from memory after the first call.
+        jwt is the jwt key returned from /login endpoint.
+
+        Returns response JSON:
+        HTML 200: {"msg":["git status","git stash pop"]}
+        HTML 401: {"detail": "Show unauthorized message(Jwt doesn't exist, or expired.)"}
+
+    /sync GET:
+        Example Usage:
+        curl -X GET http://localhost:8002/api/sync?since={watermark}&jwt={jwt}
+
+        Returns the commands and macros saved after the watermark, oldest first, and the watermark to send next time.
+        since is the watermark returned by the previous call, leaving it empty returns everything.
+        When more is true there are more commands waiting, call again with the new watermark.
+        jwt is the jwt key returned from /login endpoint.
+
+        Returns response JSON:
+        HTML 200: {"msg":{"commands":[[6,"command6"]],"macros":[[2,"macroname",["command1","command6"]]]},"watermark":"6.2","more":false}
+        HTML 400: {"detail": "Watermark has to look like <command id>.<macro id>"}
+        HTML 401: {"detail": "Show unauthorized message(Jwt doesn't exist, or expired.)"}
+
+    /ws/sync WEBSOCKET:
+        Example Usage:
+        websocat "ws://localhost:8002/api/ws/sync?since={watermark}&jwt={jwt}"
+
+        Sends what /sync returns for the watermark, then the same message, holding only what is new, whenever the user saves something.
+        Messages the client sends are ignored. The connection is closed with code 1008 when the token is wrong or expires.
+
+        Messages:
+        {"msg":{"commands":[[7,"command7"]],"macros":[]},"watermark":"7.2","more":false}
+
+    /export GET:
+        Example Usage:
+        curl --compressed -o cins-snapshot.ndjson.gz -X GET http://localhost:8002/api/export?jwt={jwt}
+
+        Streams everything the user saved as newline delimited json arrays, gzip compressed when the client accepts it:
+          ["cins-snapshot",1], then ["m",macro id,name] and ["mc",macro id,command id,order] lines,
+          then ["c",command id,command,hits,last used,frecency] lines in id order.
+        jwt is the jwt key returned from /login endpoint.
+
+        Returns:
+        HTML 200: the snapshot
+        HTML 401: {"detail": "Show unauthorized message(Jwt doesn't exist, or expired.)"}
+
+    /import POST:
+        Example Usage:
+        curl -X POST http://localhost:8002/api/import?jwt={jwt} -H "Content-Type: application/gzip" --data-binary @cins-snapshot.ndjson.gz
+
+        Saves the commands and macros of a snapshot returned by /export, gzip compressed or not, read as it arrives.
+        Commands already saved add up their hits and frecency, macros whose name is taken are skipped.
+        jwt is the jwt key returned from /login endpoint.
+
+        Returns response JSON:
+        HTML 200: {"msg":{"commands":2600,"macros":2,"skipped_macros":1}}
+        HTML 400: {"detail": "Body is not a cins snapshot, make one with /export. 0 commands were restored before it."}
+        HTML 401: {"detail": "Show unauthorized message(Jwt doesn't exist, or expired.)"}
+
     /macros GET:
         Example Usage:
         curl -X GET http://localhost:8002/api/macros?jwt={jwt}
@@ -126,6 +240,9 @@ def help():
         exists/commands have incorrect command id in it"}
 """)
 
+def busy_response():
+    return JSONResponse(content={"detail": "Too many logins at once, try again in a moment."}, status_code=503, headers={"Retry-After": "1"})
+
 @app.post("/login",
         summary="Login",
         description="Show login message",
@@ -135,20 +252,33 @@ def help():
             "model": MsgResponse
         },400:{
             "description": "Invalid credentials",
+        },503:{
+            "description": "Too many password checks are already waiting, retry later.",
         }
         })
-def login(username: str = Form(...,min_length=4,max_length=31),password: str = Form(...,min_length=8)):
+async def login(username: str = Form(...,min_length=4,max_length=31),password: str = Form(...,min_length=8),sql: sqlconn = Depends(get_replica_sql)):
     username = escape(username)
-    password_bytes = bytes(password,"utf-8")
-    with sqlconn() as sql:
-        user_exists = sql.session.execute(Select.user({"username":username})).scalars().all()
-        if not user_exists:
-            return JSONResponse(content={"detail": "Credentials are invalid."}, status_code=400)
-        if not bcrypt.checkpw(password_bytes,bytes(user_exists[0].password,"utf-8")): 
+    user_exists = await sql.scalars(Select.user({"username":username}))
+    if not user_exists and sql.engine is not sql_engine:
+        #registered a moment ago and not on the replica yet.
+        async with connect() as primary:
+            user_exists = await primary.scalars(Select.user({"username":username}))
+    if not user_exists:
+        return JSONResponse(content={"detail": "Credentials are invalid."}, status_code=400)
+    try:
+        if not await password_hasher.check(password,user_exists[0].password): 
             return JSONResponse(content={"detail": "Credentials are invalid."}, status_code=400)
-        expire_at = str(datetime.now()+timedelta(hours=4))
-        auth_jwt_token = generate_jwt_token({"expire_at":expire_at,"user":user_exists[0].id})
-        return MsgResponse(msg = auth_jwt_token)
+        if password_hasher.needs_rehash(user_exists[0].password):
+            #work factor changed since this hash was made, a failed update just retries next login.
+            hashed_pw = await password_hasher.hash(password)
+            async with connect() as primary:
+                if await primary.execute(Update.user_password({"user_id":user_exists[0].id,"password":hashed_pw})):
+                    await primary.commit()
+    except HasherBusy:
+        return busy_response()
+    expire_at = datetime.now(timezone.utc)+timedelta(hours=4)
+    auth_jwt_token = generate_jwt_token({"exp":expire_at,"user":user_exists[0].id})
+    return MsgResponse(msg = auth_jwt_token)
 
 @app.post("/register",
         summary="Register",
@@ -159,19 +289,110 @@ def login(username: str = Form(...,min_length=4,max_length=31),password: str = F
             "model": MsgResponse
         },400:{
             "description": "Show unauthorized message(Username already exists aka db based errors.)",
+        },503:{
+            "description": "Too many password hashes are already waiting, retry later.",
         }
         })
-def register(username: str = Form(...,min_length=4,max_length=31),password: str = Form(...,min_length=8)):
+async def register(username: str = Form(...,min_length=4,max_length=31),password: str = Form(...,min_length=8),sql: sqlconn = Depends(get_sql)):
     username = escape(username)
-    with sqlconn() as sql:
-        user_exists = sql.session.execute(Select.user({"username":username})).mappings().fetchall()
-        if user_exists:
-            return JSONResponse(content={"detail": "Username already exists."}, status_code=400)
-        password_bytes = bytes(password,"utf-8")
-        hashed_pw = bcrypt.hashpw(password_bytes,bcrypt.gensalt())
-        user = User(username = username,password = hashed_pw)
-        sql.session.add(user)
-        sql.session.commit()
-        return MsgResponse(msg ="You are registered now, yay!")
+    user_exists = await sql.all(Select.user({"username":username}))
+    if user_exists:
+        return JSONResponse(content={"detail": "Username already exists."}, status_code=400)
+    try:
+        hashed_pw = await password_hasher.hash(password)
+    except HasherBusy:
+        return busy_response()
+    user = User(username = username,password = hashed_pw)
+    sql.add(user)
+    if not await sql.commit():
+        return JSONResponse(content={"detail": "Username already exists."}, status_code=400)
+    return MsgResponse(msg ="You are registered now, yay!")
+
+def require_metrics_access(authorization: str = Header("", include_in_schema=False)):
+    #Shared dependency of /metrics and /stats, they are only there when turned on and behind METRICS_TOKEN when it's set.
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if METRICS_TOKEN and not hmac.compare_digest(authorization.encode(), b"Bearer " + METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Send the metrics token as a bearer token.")
+
+@app.get("/stats/pool",
+        summary="Connection pool stats",
+        description="Show database connection pool usage, checkout counts and time spent waiting for a connection.",
+        include_in_schema=METRICS_ENABLED,
+        dependencies=[Depends(require_metrics_access)],
+        responses={
+        200: {
+            "description": "Return pool stats.",
+        },401:{
+            "description": "METRICS_TOKEN is set and wasn't sent as a bearer token.",
+        },404:{
+            "description": "Metrics are turned off (METRICS_ENABLED=false).",
+        }
+        })
+def pool_status():
+    return JSONResponse(content={"msg": pool_stats.snapshot(sql_engine.pool)}, status_code=200)
+
+@app.get("/stats/passwords",
+        summary="Password hashing stats",
+        description="Show the password hashing executor's in flight and queued work, and how many requests it turned away.",
+        include_in_schema=METRICS_ENABLED,
+        dependencies=[Depends(require_metrics_access)],
+        responses={
+        200: {
+            "description": "Return password hashing stats.",
+        },401:{
+            "description": "METRICS_TOKEN is set and wasn't sent as a bearer token.",
+        },404:{
+            "description": "Metrics are turned off (METRICS_ENABLED=false).",
+        }
+        })
+def password_status():
+    return JSONResponse(content={"msg": password_hasher.snapshot()}, status_code=200)
+
+@app.get("/metrics",
+        summary="Prometheus metrics",
+        description="Request latency and response sizes per route, query timings and rows per query builder, pool and password hashing stats, in the prometheus text format.",
+        include_in_schema=METRICS_ENABLED,
+        dependencies=[Depends(require_metrics_access)],
+        responses={
+        200: {
+            "description": "Return metrics.",
+        },401:{
+            "description": "METRICS_TOKEN is set and wasn't sent as a bearer token.",
+        },404:{
+            "description": "Metrics are turned off (METRICS_ENABLED=false).",
+        }
+        })
+def prometheus_metrics():
+    pool = pool_stats.snapshot(sql_engine.pool)
+    hasher = password_hasher.snapshot()
+    extra = [
+        ("cins_sql_pool_size", "gauge", "Connections the pool keeps open.", pool["size"]),
+        ("cins_sql_pool_checked_out", "gauge", "Connections in use right now.", pool["checked_out"]),
+        ("cins_sql_pool_overflow", "gauge", "Connections open beyond the pool size.", pool["overflow"]),
+        ("cins_sql_pool_checkouts_total", "counter", "Connections handed out by the pool.", pool["checkouts"]),
+        ("cins_sql_pool_timeouts_total", "counter", "Requests that gave up waiting for a connection.", pool["timeouts"]),
+        ("cins_sql_pool_wait_seconds_total", "counter", "Time spent waiting for a connection.", pool["wait_seconds_total"]),
+        ("cins_password_hash_in_flight", "gauge", "Password hashes being computed.", hasher["in_flight"]),
+        ("cins_password_hash_queued", "gauge", "Password hashes waiting for a worker.", hasher["queued"]),
+        ("cins_password_hash_completed_total", "counter", "Password hashes computed or checked.", hasher["completed"]),
+        ("cins_password_hash_rejected_total", "counter", "Logins and registrations turned away with a 503.", hasher["rejected"]),
+    ]
+    return PlainTextResponse(metrics.render(extra), media_type="text/plain; version=0.0.4")
+
+@app.on_event("startup")
+def open_invalidation_log():
+    #a file this worker can't use stops it here, rather than failing every request that touches a cache.
+    if invalidations.path:
+        invalidations.mapping()
+
+@app.on_event("startup")
+async def warm_sql_pool():
+    for engine in [sql_engine] + replica_engines:
+        await warm_pool(engine, SQL_POOL_WARM)
+
+@app.on_event("shutdown")
+def stop_password_hasher():
+    password_hasher.shutdown()
 
 from app import views_funcs
@@ -1,14 +1,33 @@
+import asyncio
+import time
 from html import escape
+from typing import Annotated, Literal, Union
 
-from fastapi import Form, Query, Request
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi import (Depends, Form, Query, Request, WebSocket,
+                     WebSocketDisconnect, status)
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from sqlalchemy.exc import IntegrityError
 
+from app.complete import completion_indexes
+from app.invalidation import user_wrote
+from app.live_sync import sync_hub
+from app.macros import macro_cache
 from app.main import app
-from app.sql.sql_connection import sqlconn
+from app.response_cache import response_cache
+from app.responses import JSONResponse, dumps
+from app.snapshot import (check_header, parse_line, read_lines,
+                          snapshot_header, snapshot_line)
+from app.sql.backend import saved_id
+from app.sql.sql_connection import (connect, get_committed_read_sql,
+                                   get_read_sql, get_sql, sqlconn)
 from app.sql.sql_queries import Insert, Select
-from app.sql.tables import Command, Macro, User
-from app.utils import check_auth, listify
+from app.sql.env_init import (BATCH_MAX_REQUESTS, BULK_CHUNK_SIZE, BULK_MAX_COMMANDS,
+                              SYNC_PAGE_SIZE)
+from app.sql.tables import COMMAND_MAX_LENGTH, Command, Macro, User
+from app.utils import (check_auth, chunks, command_hash, format_watermark,
+                       frecency_now, parse_commands, parse_watermark,
+                       require_auth)
 from app.views_api import MsgResponse
 
 
@@ -23,23 +42,54 @@ from app.views_api import MsgResponse
             "description": "Show unauthorized message(Jwt doesn't exist, or expired.)",
         }
         })
-def search_command(keyword: str = Query("", description="Keyword to search for, leaving it empty will return the latest command(s) you saved."),
+async def search_command(request: Request, keyword: str = Query("", description="Keyword to search for, leaving it empty will return the latest command(s) you saved."),
                 limit: int = Query(0, description="Limit of returned commands, starting from latest, leaving this 0 will return all commands that keyword matches."),
-                jwt:str = Query(description="Jwt used for auth."),
-                include_ids:bool = Query(False,description="Include id numbers of commands in the result(to help create macros)")):
-    auth = check_auth(jwt)
-    if not auth:
-        return JSONResponse(content={"detail": "Can't get the user because token is expired or wrong."}, status_code=401)
-    with sqlconn() as sql:
-        query_data = {"user_id":auth["user"]}
-        if limit > 0:
-            query_data["limit"] = limit
-        if keyword:
-            query_data["keyword"] = keyword
-        if include_ids:
-            query_data["include_ids"] = include_ids
-        commands = listify(sql.session.execute(Select.command(query_data)).fetchall())
-        return JSONResponse(content={"msg": commands}, status_code=200)
+                auth: dict = Depends(require_auth),
+                include_ids:bool = Query(False,description="Include id numbers of commands in the result(to help create macros)"),
+                before_id: int = Query(0, ge=0, description="Return commands older than this id, use next_cursor of the previous page."),
+                after_id: int = Query(0, ge=0, description="Return commands newer than this id, oldest first."),
+                sort: str = Query("relevance", pattern="^(relevance|recent|frecency)$", description="Order of the result: relevance (of keyword matches), recent, or frecency (most used, recently). Pages requested with a cursor are always in id order."),
+                stream: bool = Query(False, description="Stream the result as newline delimited json, one command per line."),
+                sql: sqlconn = Depends(get_read_sql)):
+    if before_id and after_id:
+        return JSONResponse(content={"detail": "Use only one of before_id and after_id."}, status_code=400)
+    query_data = search_query_data(auth["user"], keyword, limit, before_id, after_id, sort)
+    query = Select.command(query_data)
+    if stream:
+        return StreamingResponse(stream_commands(query, include_ids, auth["user"]), media_type="application/x-ndjson")
+    async def load():
+        return search_result(await sql.all(query), query_data, include_ids)
+    return await response_cache.respond(request, auth["user"], load)
+
+def search_query_data(user_id, keyword, limit, before_id, after_id, sort):
+    query_data = {"user_id":user_id}
+    if limit > 0:
+        query_data["limit"] = limit
+    if keyword:
+        query_data["keyword"] = keyword
+    if before_id:
+        query_data["before_id"] = before_id
+    elif after_id:
+        query_data["after_id"] = after_id
+    elif sort != "recent":
+        query_data["sort"] = sort
+    return query_data
+
+def search_result(rows, query_data, include_ids):
+    #rows are (id, command) and are encoded as they are, row[1:] drops the id.
+    commands = rows if include_ids else [row[1:] for row in rows]
+    #ranked pages can't be continued by id, ask for sort=recent to page through them.
+    ranked = query_data.get("sort") == "frecency" or query_data.get("sort") == "relevance" and Select.fulltext_usable(query_data.get("keyword", ""))
+    next_cursor = None
+    if "limit" in query_data and len(rows) == query_data["limit"] and not ranked:
+        next_cursor = rows[-1].id
+    return {"msg": commands, "next_cursor": next_cursor}
+
+async def stream_commands(query, include_ids, user_id):
+    #Gets its own connection, the request's session is closed before the body is sent.
+    async with connect(read_only=True, user_id=user_id) as sql:
+        async for rows in sql.stream(query):
+            yield b"".join(dumps(row if include_ids else row[1:])+b"\n" for row in rows)
     
 @app.post("/commands",
         summary="Save a command",
@@ -54,17 +104,133 @@ def search_command(keyword: str = Query("", description="Keyword to search for,
             "description": "Bad request, command is empty or just whitespaces.",
         }
         })
-def save_command(command: str = Form("",max_length=511),jwt:str = Query(description="Jwt used for auth.")):
-    auth = check_auth(jwt)
-    if not auth:
-        return JSONResponse(content={"detail": "Can't get the user because token is expired or wrong."}, status_code=401)
+async def save_command(command: str = Form("",max_length=COMMAND_MAX_LENGTH),auth: dict = Depends(require_auth),sql: sqlconn = Depends(get_sql)):
     if not command:
         return JSONResponse(content={"detail": "You wouldn't want to insert an empty command."}, status_code=400)
-    with sqlconn() as sql:
-        #can also add a check if command already exists, this only matters informing the user though, skipped for now.
-        sql.session.execute(Insert.command({"user_id": auth["user"],"command": command}))
-        sql.session.commit()
-        return MsgResponse(msg = f"I managed to save your command. {command}")
+    #can also add a check if command already exists, this only matters informing the user though, skipped for now.
+    result = await sql.lock_user(auth["user"]) and await sql.execute(Insert.command({"user_id": auth["user"],"command": command}))
+    if not result or not await sql.commit():
+        return JSONResponse(content={"detail": "Couldn't save your command, try again later."}, status_code=500)
+    completion_indexes.add(auth["user"], saved_id(result), command, frecency_now())
+    user_wrote(auth["user"])
+    return MsgResponse(msg = f"I managed to save your command. {command}")
+
+@app.post("/commands/bulk",
+        summary="Save many commands",
+        description="Save a json array or ndjson stream of commands in one request, eg. a whole shell history file.",
+        responses={
+        200: {
+            "description": "Return how many commands were received, saved and skipped.",
+            "model": MsgResponse
+        },401:{
+            "description": "Show unauthorized message(Jwt doesn't exist, or expired.)",
+        },400:{
+            "description": "Bad request, body isn't a list of commands or has too many of them.",
+        }
+        })
+async def save_commands_bulk(request: Request,auth: dict = Depends(require_auth),sql: sqlconn = Depends(get_sql)):
+    try:
+        received = parse_commands(await request.body(), request.headers.get("content-type", ""))
+    except ValueError:
+        return JSONResponse(content={"detail": "Body has to be a json array or ndjson stream of commands."}, status_code=400)
+    if len(received) > BULK_MAX_COMMANDS:
+        return JSONResponse(content={"detail": f"Send at most {BULK_MAX_COMMANDS} commands per request."}, status_code=400)
+    #dict keeps the first occurrence of each command in order, duplicates against saved rows are left to the upsert.
+    commands = list(dict.fromkeys(command for command in received if command.strip() and len(command) <= COMMAND_MAX_LENGTH))
+    saved = 0
+    for chunk in chunks(commands, BULK_CHUNK_SIZE):
+        if not await sql.lock_user(auth["user"]) or not await sql.execute(Insert.command([{"user_id": auth["user"],"command": command} for command in chunk])) or not await sql.commit():
+            return JSONResponse(content={"detail": f"Couldn't save your commands, {saved} of them were saved before the error."}, status_code=500)
+        saved += len(chunk)
+        completion_indexes.invalidate(auth["user"])
+        user_wrote(auth["user"])
+    return JSONResponse(content={"msg": {"received": len(received), "saved": saved, "skipped": len(received) - saved}}, status_code=200)
+
+class BatchSave(BaseModel):
+    op: Literal["save"]
+    command: str
+
+class BatchSearch(BaseModel):
+    op: Literal["search"]
+    keyword: str = ""
+    limit: int = 0
+    include_ids: bool = False
+    before_id: int = Field(0, ge=0)
+    after_id: int = Field(0, ge=0)
+    sort: str = Field("relevance", pattern="^(relevance|recent|frecency)$")
+
+class BatchRequest(BaseModel):
+    requests: list[Annotated[Union[BatchSave, BatchSearch], Field(discriminator="op")]] = Field(max_length=BATCH_MAX_REQUESTS)
+
+@app.post("/batch",
+        summary="Run several saves and searches",
+        description="Run a list of command saves and searches in one request, in order, and return their results in the same order.",
+        responses={
+        200: {
+            "description": "Return one result per request, {msg} or {detail, status_code} when that request failed.",
+            "model": MsgResponse
+        },401:{
+            "description": "Show unauthorized message(Jwt doesn't exist, or expired.)",
+        },500:{
+            "description": "Saves couldn't be written, nothing in the batch was saved.",
+        }
+        })
+async def batch(body: BatchRequest,auth: dict = Depends(require_auth),sql: sqlconn = Depends(get_sql)):
+    results = []
+    pending = []
+
+    async def save_pending():
+        #consecutive saves go to the database as one insert, a search after them sees them.
+        if pending and not (await sql.lock_user(auth["user"]) and await sql.execute(Insert.command([{"user_id": auth["user"],"command": command} for command in dict.fromkeys(pending)]))):
+            return False
+        pending.clear()
+        return True
+
+    for request in body.requests:
+        if request.op == "save":
+            if not request.command:
+                results.append({"detail": "You wouldn't want to insert an empty command.", "status_code": 400})
+                continue
+            if len(request.command) > COMMAND_MAX_LENGTH:
+                #checked per item, one over-long command shouldn't fail the saves and searches next to it.
+                results.append({"detail": f"Commands can be at most {COMMAND_MAX_LENGTH} characters.", "status_code": 400})
+                continue
+            pending.append(request.command)
+            results.append({"msg": f"I managed to save your command. {request.command}"})
+        elif request.before_id and request.after_id:
+            results.append({"detail": "Use only one of before_id and after_id.", "status_code": 400})
+        else:
+            if not await save_pending():
+                break
+            query_data = search_query_data(auth["user"], request.keyword, request.limit, request.before_id, request.after_id, request.sort)
+            results.append(search_result(await sql.all(Select.command(query_data)), query_data, request.include_ids))
+    else:
+        if await save_pending() and await sql.commit():
+            if any(request.op == "save" for request in body.requests):
+                completion_indexes.invalidate(auth["user"])
+                user_wrote(auth["user"])
+            return JSONResponse(content={"msg": results}, status_code=200)
+    return JSONResponse(content={"detail": "Couldn't save your commands, try again later."}, status_code=500)
+
+@app.get("/complete",
+        summary="Autocomplete a command",
+        description="Return the most frecent (frequently and recently used) saved commands starting with the given prefix.",
+        responses={
+        200: {
+            "description": "Return matching commands, most frecent first.",
+            "model": MsgResponse
+        },401:{
+            "description": "Show unauthorized message(Jwt doesn't exist, or expired.)",
+        }
+        })
+async def complete_command(request: Request, prefix: str = Query("", description="Start of the command, leaving it empty returns the most frecent commands."),
+                limit: int = Query(10, ge=1, le=100, description="Number of completions to return."),
+                auth: dict = Depends(require_auth),sql: sqlconn = Depends(get_read_sql)):
+    async def load():
+        #the index is built from the database once per user, later calls don't touch it.
+        index = await completion_indexes.get(auth["user"], lambda: sql.all(Select.command_ranks({"user_id":auth["user"]})))
+        return {"msg": index.complete(prefix, limit)}
+    return await response_cache.respond(request, auth["user"], load)
 
 @app.get("/macro",
         summary="Search a macro",
@@ -77,17 +243,14 @@ def save_command(command: str = Form("",max_length=511),jwt:str = Query(descript
             "description": "Show unauthorized message(Jwt doesn't exist, or expired.)",
         }
         })
-def search_macro(name: str = Query("", description="Name to search for, leaving it empty will return the latest macro you saved."),
-                jwt:str = Query(description="Jwt used for auth.")):
-    auth = check_auth(jwt)
-    if not auth:
-        return JSONResponse(content={"detail": "Can't get the user because token is expired or wrong."}, status_code=401)
-    with sqlconn() as sql:
-        query_data = {"user_id":auth["user"]}
-        if name:
-            query_data["name"] = name
-        commands = sql.session.execute(Select.macro(query_data)).scalars().fetchall()
-        return JSONResponse(content={"msg": commands}, status_code=200)
+async def search_macro(request: Request, name: str = Query("", description="Name to search for, leaving it empty will return the latest macro you saved."),
+                auth: dict = Depends(require_auth),sql: sqlconn = Depends(get_read_sql)):
+    query_data = {"user_id":auth["user"]}
+    if name:
+        query_data["name"] = name
+    async def load():
+        return {"msg": await macro_cache.macro(auth["user"], name, lambda: sql.scalars(Select.macro(query_data)))}
+    return await response_cache.respond(request, auth["user"], load)
     
 @app.get("/macros",
         summary="Retrieve all macro names",
@@ -100,14 +263,11 @@ def search_macro(name: str = Query("", description="Name to search for, leaving
             "description": "Show unauthorized message(Jwt doesn't exist, or expired.)",
         }
         })
-def fetch_macros(jwt:str = Query(description="Jwt used for auth.")):
-    auth = check_auth(jwt)
-    if not auth:
-        return JSONResponse(content={"detail": "Can't get the user because token is expired or wrong."}, status_code=401)
-    with sqlconn() as sql:
-        query_data = {"user_id":auth["user"]}
-        macros = sql.session.execute(Select.macros(query_data)).scalars().fetchall()
-        return JSONResponse(content={"msg": macros}, status_code=200)
+async def fetch_macros(request: Request, auth: dict = Depends(require_auth),sql: sqlconn = Depends(get_read_sql)):
+    query_data = {"user_id":auth["user"]}
+    async def load():
+        return {"msg": await macro_cache.names(auth["user"], lambda: sql.scalars(Select.macros(query_data)))}
+    return await response_cache.respond(request, auth["user"], load)
     
 @app.post("/macro",
         summary="Save a macro",
@@ -122,26 +282,231 @@ def fetch_macros(jwt:str = Query(description="Jwt used for auth.")):
             "description": "Bad request, macro is empty or just whitespaces or macro name already exists/commands have incorrect command id in it",
         }
         })
-def save_macro(name: str = Form(max_length=255),commands: str = Form("",max_length=255) ,jwt:str = Query(description="Jwt used for auth.")):
-    auth = check_auth(jwt)
-    if not auth:
-        return JSONResponse(content={"detail": "Can't get the user because token is expired or wrong."}, status_code=401)
+async def save_macro(name: str = Form(max_length=255),commands: str = Form("",max_length=255) ,auth: dict = Depends(require_auth),sql: sqlconn = Depends(get_sql)):
     if not commands:
         return JSONResponse(content={"detail": "You wouldn't want to insert an empty macro."}, status_code=400)
-    with sqlconn() as sql:
-        query_data = {"user_id":auth["user"],"name":name}
-        exist_check = sql.session.execute(Select.macro_exists(query_data)).fetchall()
-        if exist_check:
-            return JSONResponse(content={"detail": "This macro name already exists"}, status_code=400)
-        command_ids = [int(cmd_id.strip()) for cmd_id in commands.replace(",", " ").split() if cmd_id.strip()]
-        macro = Macro(user_id = auth["user"],name = escape(name))
-        sql.session.add(macro)
-        sql.session.flush()
-        insert_data = []
-        for order,command_id in enumerate(command_ids,start=1):
-            insert_data.append({"macro_id":macro.id,"command_id":command_id,"order":order})
-        if sql.execute(Insert.macro_command(insert_data)):
-            sql.session.commit()
-            return MsgResponse(msg = f"I managed to save your macro.")
-        else:
-            return JSONResponse(content={"detail": "You probably entered incorrect command id in the macro"}, status_code=400)
\ No newline at end of file
+    try:
+        command_ids = [int(cmd_id) for cmd_id in commands.replace(",", " ").split()]
+    except ValueError:
+        return JSONResponse(content={"detail": "Commands have to be comma separated command ids."}, status_code=400)
+    if not await sql.lock_user(auth["user"]):
+        return JSONResponse(content={"detail": "Couldn't save your macro, try again later."}, status_code=500)
+    macro = Macro(user_id = auth["user"],name = escape(name))
+    sql.add(macro)
+    try:
+        #the user_id_name unique key rejects a taken name, no need to look it up first.
+        await sql.flush()
+    except IntegrityError:
+        return JSONResponse(content={"detail": "This macro name already exists"}, status_code=400)
+    insert_data = []
+    for order,command_id in enumerate(command_ids,start=1):
+        insert_data.append({"macro_id":macro.id,"command_id":command_id,"order":order})
+    if await sql.execute(Insert.macro_command(insert_data)) and await sql.commit():
+        macro_cache.invalidate(auth["user"])
+        user_wrote(auth["user"])
+        return MsgResponse(msg = f"I managed to save your macro.")
+    else:
+        return JSONResponse(content={"detail": "You probably entered incorrect command id in the macro"}, status_code=400)
+
+@app.get("/sync",
+        summary="Fetch changes since the last sync",
+        description="Return commands and macros saved after the given watermark, and the watermark to send next time.",
+        responses={
+        200: {
+            "description": "Return new commands and macros.",
+            "model": MsgResponse
+        },401:{
+            "description": "Show unauthorized message(Jwt doesn't exist, or expired.)",
+        },400:{
+            "description": "Bad request, watermark is malformed.",
+        }
+        })
+async def sync(request: Request, since: str = Query("", description="Watermark returned by the previous sync, leaving it empty returns everything."),
+                auth: dict = Depends(require_auth),sql: sqlconn = Depends(get_committed_read_sql)):
+    try:
+        command_id, macro_id = parse_watermark(since)
+    except ValueError:
+        return JSONResponse(content={"detail": "Watermark has to look like <command id>.<macro id>"}, status_code=400)
+    async def load():
+        return await sync_page(sql, auth["user"], command_id, macro_id)
+    return await response_cache.respond(request, auth["user"], load)
+
+async def sync_page(sql, user_id, command_id, macro_id):
+    #ids are auto increment and saved rows never change, so everything above the watermark is new. sql has to be
+    # read_committed: a user's saves commit in id order (see sqlconn.lock_user), a later one can't be seen before them.
+    commands = await sql.all(Select.command({"user_id":user_id,"after_id":command_id,"limit":SYNC_PAGE_SIZE}))
+    macros = await sql.all(Select.macros_since({"user_id":user_id,"after_id":macro_id}))
+    macro_commands = {macro.id: [] for macro in macros}
+    if macros:
+        for row in await sql.all(Select.macro_commands({"macro_ids":list(macro_commands)})):
+            macro_commands[row.macro_id].append(row.command)
+    return {"msg": {
+                "commands": commands,
+                "macros": [[macro.id, macro.name, macro_commands[macro.id]] for macro in macros]},
+            "watermark": format_watermark(commands[-1].id if commands else command_id, macros[-1].id if macros else macro_id),
+            "more": len(commands) == SYNC_PAGE_SIZE}
+
+@app.websocket("/ws/sync")
+async def live_sync(websocket: WebSocket, jwt: str = Query(description="Jwt used for auth."),
+                since: str = Query("", description="Watermark of the client's last sync, leaving it empty sends everything first.")):
+    #Sends what /sync would return for the watermark, then the same for every save of the user as it is committed, on any worker.
+    auth = check_auth(jwt)
+    if not auth:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Token is expired or wrong.")
+        return
+    try:
+        command_id, macro_id = parse_watermark(since)
+    except ValueError:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Watermark has to look like <command id>.<macro id>")
+        return
+    await websocket.accept()
+    saved = sync_hub.subscribe(auth["user"])
+    #anything the client sends is ignored, waiting for it tells when it goes away.
+    received = asyncio.ensure_future(websocket.receive())
+    first = True
+    try:
+        while True:
+            #cleared before reading, a save committed meanwhile wakes the loop again.
+            saved.clear()
+            #a session per page, idle connections don't hold on to pooled connections.
+            async with connect(read_only=True, user_id=auth["user"], read_committed=True) as sql:
+                page = await sync_page(sql, auth["user"], command_id, macro_id)
+            if first or page["msg"]["commands"] or page["msg"]["macros"]:
+                await websocket.send_text(dumps(page).decode())
+            first = False
+            command_id, macro_id = parse_watermark(page["watermark"])
+            if page["more"]:
+                continue
+            while not saved.is_set():
+                woken = asyncio.ensure_future(saved.wait())
+                done, _ = await asyncio.wait((received, woken), timeout=max(auth["exp"] - time.time(), 0),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                woken.cancel()
+                if received in done:
+                    if received.result()["type"] == "websocket.disconnect":
+                        return
+                    received = asyncio.ensure_future(websocket.receive())
+                elif not done:
+                    await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Token expired, log in again.")
+                    return
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sync_hub.unsubscribe(auth["user"], saved)
+        received.cancel()
+
+@app.get("/export",
+        summary="Export everything you saved",
+        description="Stream a snapshot of your commands (with their use counts) and macros as newline delimited json, gzip compressed for clients accepting it. POST it to /import to restore it.",
+        responses={
+        200: {
+            "description": "Return the snapshot, see app/snapshot.py for its lines.",
+        },401:{
+            "description": "Show unauthorized message(Jwt doesn't exist, or expired.)",
+        }
+        })
+async def export_snapshot(auth: dict = Depends(require_auth)):
+    return StreamingResponse(snapshot_rows(auth["user"]), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": 'attachment; filename="cins-snapshot.ndjson"'})
+
+async def snapshot_rows(user_id):
+    #Gets its own connection like stream_commands, commands come from a server side cursor a chunk at a time.
+    async with connect(read_only=True, user_id=user_id) as sql:
+        yield snapshot_header()
+        macros = await sql.all(Select.macros_since({"user_id":user_id,"after_id":0}))
+        macro_commands = await sql.all(Select.export_macro_commands({"user_id":user_id})) if macros else []
+        yield b"".join([snapshot_line("m", row) for row in macros] + [snapshot_line("mc", row) for row in macro_commands])
+        async for rows in sql.stream(Select.export_commands({"user_id":user_id})):
+            yield b"".join(snapshot_line("c", row) for row in rows)
+
+@app.post("/import",
+        summary="Restore a snapshot",
+        description="Save the commands and macros of a snapshot made by /export, sent as it is (gzip compressed or not). Commands you already have add up their use counts, macros whose name you already use are skipped.",
+        responses={
+        200: {
+            "description": "Return how many commands and macros were restored and how many macros were skipped.",
+            "model": MsgResponse
+        },401:{
+            "description": "Show unauthorized message(Jwt doesn't exist, or expired.)",
+        },400:{
+            "description": "Bad request, body isn't a snapshot. Commands before the broken line are kept.",
+        }
+        })
+async def import_snapshot(request: Request,auth: dict = Depends(require_auth),sql: sqlconn = Depends(get_sql)):
+    user_id = auth["user"]
+    macros = []
+    macro_commands = {}
+    #ids of the snapshot's commands that macros use, and what they were saved as. Other ids are forgotten chunk by chunk.
+    wanted_ids = set()
+    saved_ids = {}
+    pending = []
+    restored = {"commands": 0, "macros": 0, "skipped_macros": 0}
+
+    async def save_pending():
+        #one upsert per chunk, in snapshot order so recent stays recent, then one lookup for the ids macros need.
+        rows = {}
+        for old_id, command, hits, last_used, frecency in pending:
+            rows.setdefault(command, {"user_id": user_id, "command": command, "hits": hits, "last_used": last_used, "frecency": frecency})
+        if not await sql.lock_user(user_id) or not await sql.execute(Insert.restored_command(list(rows.values()))) or not await sql.commit():
+            return False
+        wanted = {}
+        for old_id, command, *_ in pending:
+            if old_id in wanted_ids:
+                wanted.setdefault(command_hash(command), []).append(old_id)
+        if wanted:
+            for row in await sql.all(Select.command_ids({"user_id":user_id,"hashes":list(wanted)})):
+                for old_id in wanted[row.command_hash]:
+                    saved_ids[old_id] = row.id
+        restored["commands"] += len(rows)
+        pending.clear()
+        completion_indexes.invalidate(user_id)
+        user_wrote(user_id)
+        return True
+
+    try:
+        lines = read_lines(request.stream())
+        check_header(await anext(lines, b""))
+        async for line in lines:
+            row = parse_line(line)
+            if row[0] == "c":
+                pending.append(row[1:])
+                if len(pending) >= BULK_CHUNK_SIZE and not await save_pending():
+                    return JSONResponse(content={"detail": f"Couldn't save your commands, {restored['commands']} of them were restored before the error."}, status_code=500)
+            elif restored["commands"] or pending:
+                raise ValueError("Macros have to come before the commands.")
+            elif row[0] == "m":
+                macros.append(row[1:])
+            else:
+                macro_commands.setdefault(row[1], []).append((row[3], row[2]))
+                wanted_ids.add(row[2])
+    except ValueError as e:
+        return JSONResponse(content={"detail": f"{e} {restored['commands']} commands were restored before it."}, status_code=400)
+    if pending and not await save_pending():
+        return JSONResponse(content={"detail": f"Couldn't save your commands, {restored['commands']} of them were restored before the error."}, status_code=500)
+
+    taken = set(await sql.scalars(Select.macros({"user_id":user_id})))
+    for old_id, name in macros:
+        command_ids = [saved_ids[command_id] for order, command_id in sorted(macro_commands.get(old_id, [])) if command_id in saved_ids]
+        if name in taken or not command_ids:
+            restored["skipped_macros"] += 1
+            continue
+        taken.add(name)
+        #a transaction per macro, a name only the user_id_name key finds taken (eg. "Deploy" next to "deploy"
+        # under MySQL's case insensitive collation) skips that one macro. names in a snapshot are escaped already, see save_macro.
+        if not await sql.lock_user(user_id):
+            return JSONResponse(content={"detail": f"Couldn't save your macros, {restored['commands']} commands and {restored['macros']} macros were restored."}, status_code=500)
+        macro = Macro(user_id = user_id,name = name)
+        sql.add(macro)
+        try:
+            await sql.flush()
+        except IntegrityError:
+            await sql.rollback()
+            restored["skipped_macros"] += 1
+            continue
+        insert_data = [{"macro_id":macro.id,"command_id":command_id,"order":order} for order,command_id in enumerate(command_ids,start=1)]
+        if not await sql.execute(Insert.macro_command(insert_data)) or not await sql.commit():
+            return JSONResponse(content={"detail": f"Couldn't save your macros, {restored['commands']} commands and {restored['macros']} macros were restored."}, status_code=500)
+        restored["macros"] += 1
+        macro_cache.invalidate(user_id)
+        user_wrote(user_id)
+    return JSONResponse(content={"msg": restored}, status_code=200)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Compare GET /commands throughput of the threaded (SQL_ASYNC=false) and async (SQL_ASYNC=true) modes.
+
+Starts one uvicorn process per mode against the database configured in the environment / .env,
+registers a benchmark user, seeds a few commands and then keeps --concurrency clients busy
+for --duration seconds.
+
+    python bench/async_vs_threaded.py --concurrency 500 --duration 20
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from common import prepare_user, start_server, summarize
+
+
+async def hammer(url, jwt, concurrency, duration, limit):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    params = {"jwt": jwt, "limit": limit, "keyword": "bench"}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = await client.get("/commands", params=params)
+                    if response.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return summarize(latencies, elapsed, errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--seed", type=int, default=200, help="Commands saved for the benchmark user.")
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--modes", default="threaded,async")
+    parser.add_argument("--response-cache", action="store_true", help="Keep the per-user response cache on, repeated reads are answered from memory then.")
+    args = parser.parse_args()
+
+    results = {}
+    for offset, mode in enumerate(args.modes.split(",")):
+        proc, url = start_server(8100 + offset, args.response_cache, SQL_ASYNC="true" if mode == "async" else "false")
+        try:
+            jwt = prepare_user(url, args.seed)
+            results[mode] = asyncio.run(hammer(url, jwt, args.concurrency, args.duration, args.limit))
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    print(f"{'mode':<10}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for mode, r in results.items():
+        print(f"{mode:<10}{r['requests']:>10}{r['errors']:>8}{r['rps']:>10.1f}{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""Per request cost of token verification: the previous check_auth (decode, key set, strptime on
+every call) against the cached check_auth, cold (first sight of a token) and warm.
+
+    JWT_SECRET_KEY=... python bench/auth_overhead.py --calls 100000
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("JWT_SECRET_KEY", "benchmark-secret-key-of-reasonable-length")
+
+import jwt
+
+from app import utils
+from app.sql.env_init import JWT_SECRET_KEY
+
+
+def previous_check_auth(token):
+    test = jwt.decode(token, JWT_SECRET_KEY, ["HS256"])
+    if test:
+        if not set(["expire_at", "user"]) == set(test.keys()):
+            return None
+        if datetime.now() < datetime.strptime(test["expire_at"],"%Y-%m-%d %H:%M:%S.%f"):
+            return test
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=100000)
+    args = parser.parse_args()
+
+    legacy_token = utils.generate_jwt_token({"expire_at": str(datetime.now() + timedelta(hours=4)), "user": 1})
+    token = utils.generate_jwt_token({"exp": datetime.now(timezone.utc) + timedelta(hours=4), "user": 1})
+    fresh_tokens = iter([utils.generate_jwt_token({"exp": int(time.time()) + 3600 + i, "user": 1}) for i in range(args.calls)])
+
+    results = {
+        "previous check_auth": timeit(lambda: previous_check_auth(legacy_token), number=args.calls),
+        "check_auth, cold": timeit(lambda: (utils.token_cache.clear(), utils.check_auth(next(fresh_tokens))), number=args.calls),
+        "check_auth, cached": timeit(lambda: utils.check_auth(token), number=args.calls),
+    }
+    for name, total in results.items():
+        print(f"{name:<22}{total / args.calls * 1e6:>10.2f} us/call")
+
+
+if __name__ == "__main__":
+    main()
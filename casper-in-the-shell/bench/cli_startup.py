@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Wall time of short cins.py invocations, run as separate processes the way a shell or key binding
+runs them: a bare interpreter for reference, a search answered from the local cache and the shell
+hook, each without and with "cins.py daemon" running. Also lists the slowest imports (-X importtime).
+
+Needs no server, the cache is filled locally and the api url points nowhere.
+
+    python bench/cli_startup.py --runs 30
+"""
+import argparse
+import base64
+import fcntl
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_cins(script):
+    spec = importlib.util.spec_from_file_location("cins", script)
+    cins = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cins)
+    return cins
+
+
+def prepare(workdir, commands):
+    payload = base64.urlsafe_b64encode(json.dumps({"user": 1}).encode()).decode().rstrip("=")
+    os.environ.update({
+        "XDG_CACHE_HOME": workdir,
+        "CINS_JWT_FILE": os.path.join(workdir, "jwt"),
+        "CINS_API_URL": "http://127.0.0.1:9/api",
+    })
+    with open(os.environ["CINS_JWT_FILE"], "w") as f:
+        f.write(f"header.{payload}.signature")
+    cins = load_cins(os.path.join(ROOT, "cins.py"))
+    db = cins.open_cache()
+    with db:
+        db.executemany("INSERT INTO commands (id, command) VALUES (?, ?)",
+                       [(i, f"git commit -m 'change {i}'" if i % 3 else f"ls -la /tmp/{i}") for i in range(1, commands + 1)])
+        cins.cache_set(db, "owner", cins.cache_owner(f"header.{payload}.signature"))
+        cins.cache_set(db, "watermark", f"{commands}.0")
+        #far in the future, so searches don't start background syncs while measuring.
+        cins.cache_set(db, "synced_at", time.time() + 86400)
+    return cins
+
+
+def measure(argv, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return statistics.median(times) * 1000, times[int(len(times) * 0.9) - 1] * 1000
+
+
+def slowest_imports(argv, count):
+    result = subprocess.run([sys.executable, "-X", "importtime"] + argv, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        #top level imports only, nested ones are counted in their parent's cumulative time.
+        if not name.startswith("  "):
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=30)
+    parser.add_argument("--commands", type=int, default=20000, help="Commands in the local cache.")
+    args = parser.parse_args()
+
+    script = os.path.join(ROOT, "cins.py")
+    scenarios = [
+        ("python -c pass", [sys.executable, "-c", "pass"]),
+        ("search (local cache)", [sys.executable, script, "search", "-kw", "commit -m 'change 42", "-l", "5"]),
+        ("hook", [sys.executable, script, "hook", "--", "echo from the benchmark"]),
+    ]
+    with tempfile.TemporaryDirectory() as workdir:
+        cins = prepare(workdir, args.commands)
+        #held for the whole run, so hooks find a "flusher" running and don't start real ones.
+        flusher_lock = open(cins.QUEUE_FILE + ".lock", "a")
+        fcntl.flock(flusher_lock, fcntl.LOCK_EX)
+
+        results = {name: [measure(argv, args.runs)] for name, argv in scenarios}
+        daemon = subprocess.Popen([sys.executable, script, "daemon"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(100):
+                if os.path.exists(cins.DAEMON_SOCKET):
+                    break
+                time.sleep(0.05)
+            for name, argv in scenarios:
+                results[name].append(measure(argv, args.runs))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+        imports = slowest_imports(scenarios[1][1][1:], 8)
+
+    print(f"{'':<24}{'no daemon p50':>14}{'p90':>8}{'daemon p50':>12}{'p90':>8}   (ms)")
+    for name, ((p50, p90), (daemon_p50, daemon_p90)) in results.items():
+        print(f"{name:<24}{p50:>14.1f}{p90:>8.1f}{daemon_p50:>12.1f}{daemon_p90:>8.1f}")
+    print("\nslowest imports of a search without the daemon (cumulative us):")
+    for cumulative, name in imports:
+        print(f"  {cumulative:>8}  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""Helpers shared by the benchmark scripts: running the api in a subprocess and preparing a user."""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_server(port, response_cache=False, **env):
+    #the same read sent over and over would be answered from the per-user response cache, not the database path measured here.
+    if not response_cache:
+        env["RESPONSE_CACHE_BYTES"] = "0"
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+                            cwd=ROOT, env=dict(os.environ, **env))
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            httpx.get(url + "/", timeout=1)
+            return proc, url
+        except httpx.TransportError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("server did not start")
+
+
+def prepare_user(url, seed, username="benchuser", password="benchpassword"):
+    credentials = {"username": username, "password": password}
+    httpx.post(url + "/register", data=credentials)
+    jwt = httpx.post(url + "/login", data=credentials).json()["msg"]
+    if seed:
+        httpx.post(url + "/commands/bulk", params={"jwt": jwt}, json=[f"echo bench {i}" for i in range(seed)], timeout=60)
+    return jwt
+
+
+def summarize(latencies, elapsed, errors=0):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"requests": 0, "errors": errors, "rps": 0.0, "p50_ms": 0.0, "p99_ms": 0.0}
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000,
+    }
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Time spent encoding a GET /commands response for a user with --commands saved commands:
+the previous listify copy + starlette's stdlib json JSONResponse against app.responses.JSONResponse
+on the result rows, and what gzip adds on top of it at a few compression levels.
+
+    python bench/encode.py --commands 100000
+"""
+import argparse
+import gzip
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, insert, select
+from starlette.responses import JSONResponse as StarletteJSONResponse
+
+from app.responses import JSONResponse
+from app.sql.tables import Base, Command
+from app.utils import command_hash
+
+
+def listify(map):
+    templist = []
+    for row in map:
+        listx = []
+        for val in row:
+            listx.append(val)
+        templist.append(listx)
+    return templist
+
+
+def best_of(repeat, func):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--commands", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine, tables=[Command.__table__])
+    with engine.begin() as conn:
+        commands = [f"git commit -m 'change number {i}' && git push origin feature/{i % 97}" for i in range(1, args.commands + 1)]
+        conn.execute(insert(Command), [{"id": i, "user_id": 1, "command": command, "command_hash": command_hash(command)}
+                                       for i, command in enumerate(commands, start=1)])
+        rows = conn.execute(select(Command.id, Command.command).order_by(Command.id.desc())).fetchall()
+
+    print(f"{args.commands} commands, best of {args.repeat}")
+    cases = [
+        ("stdlib json, listify", lambda: StarletteJSONResponse(content={"msg": listify(rows), "next_cursor": None}).body),
+        ("orjson, rows as they are", lambda: JSONResponse(content={"msg": rows, "next_cursor": None}).body),
+        ("orjson, row[1:] (no ids)", lambda: JSONResponse(content={"msg": [row[1:] for row in rows], "next_cursor": None}).body),
+    ]
+    body = None
+    for name, func in cases:
+        ms, body = best_of(args.repeat, func)
+        print(f"  {name:<30}{ms:>9.1f} ms {len(body):>11} bytes")
+    for level in (1, 5, 9):
+        ms, compressed = best_of(args.repeat, lambda: gzip.compress(body, level))
+        print(f"  {'+ gzip level ' + str(level):<30}{ms:>9.1f} ms {len(compressed):>11} bytes")
+
+
+if __name__ == "__main__":
+    main()
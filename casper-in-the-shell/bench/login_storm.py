@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Show that GET /commands latency holds up while the server is flooded with logins.
+
+Measures /commands with --probes concurrent clients alone for --duration seconds, then again
+while --logins clients keep calling /login, and prints both next to the password hashing stats.
+
+    python bench/login_storm.py --logins 200 --probes 20 --duration 15
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from common import prepare_user, start_server, summarize
+
+
+async def loop_requests(client, deadline, send, latencies, counts):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await send(client)
+            counts[response.status_code] = counts.get(response.status_code, 0) + 1
+        except httpx.HTTPError:
+            counts["error"] = counts.get("error", 0) + 1
+        latencies.append(time.perf_counter() - start)
+
+
+async def phase(url, jwt, probes, logins, duration):
+    credentials = {"username": "benchuser", "password": "benchpassword"}
+    limits = httpx.Limits(max_connections=probes + logins)
+    probe_latencies, login_latencies = [], []
+    probe_counts, login_counts = {}, {}
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+        deadline = time.perf_counter() + duration
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(loop_requests(client, deadline, lambda c: c.get("/commands", params={"jwt": jwt, "limit": 10}), probe_latencies, probe_counts)
+              for _ in range(probes)),
+            *(loop_requests(client, deadline, lambda c: c.post("/login", data=credentials), login_latencies, login_counts)
+              for _ in range(logins)),
+        )
+        elapsed = time.perf_counter() - started
+        stats = (await client.get("/stats/passwords")).json()["msg"]
+    return summarize(probe_latencies, elapsed), summarize(login_latencies, elapsed), login_counts, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=200, help="Concurrent clients logging in during the storm.")
+    parser.add_argument("--probes", type=int, default=20, help="Concurrent clients calling /commands.")
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--port", type=int, default=8110)
+    args = parser.parse_args()
+
+    #the stats printed at the end come from /stats/passwords.
+    proc, url = start_server(args.port, METRICS_ENABLED="true", METRICS_TOKEN="")
+    try:
+        jwt = prepare_user(url, 200)
+        quiet, _, _, _ = asyncio.run(phase(url, jwt, args.probes, 0, args.duration))
+        storm, logins, login_counts, stats = asyncio.run(phase(url, jwt, args.probes, args.logins, args.duration))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    print(f"{'/commands':<22}{'requests':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    print(f"{'no logins':<22}{quiet['requests']:>10}{quiet['p50_ms']:>10.1f}{quiet['p99_ms']:>10.1f}")
+    print(f"{'during login storm':<22}{storm['requests']:>10}{storm['p50_ms']:>10.1f}{storm['p99_ms']:>10.1f}")
+    print(f"logins: {logins['requests']} answered, status codes {login_counts}, p99 {logins['p99_ms']:.1f} ms")
+    print(f"password hashing: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""Seeds one benchmark user per dataset size with that many commands and --macros macros, then
+measures throughput and p50/p99 latency of every scenario at every concurrency level and writes
+all of it, with the commit and settings it ran with, to a json file. Run it on two commits and
+pass the older file as --baseline to see what changed.
+
+The api is started against the database configured in the environment / .env, or --sql-url.
+bench/docker-compose.yml runs a throwaway MySQL for it:
+
+    docker compose -f bench/docker-compose.yml up -d
+    MYSQL_HOST=127.0.0.1:3307 MYSQL_USER=bench MYSQL_PASSWORD=bench MYSQL_DB=cins \\
+        python bench/suite.py --sizes 1000,100000,1000000 --concurrency 1,16,64 --duration 10
+
+Seeded users are kept, a second run on the same database skips seeding the sizes it finds.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import httpx
+
+from common import ROOT, start_server, summarize
+
+#scenarios run in this order, the writing ones last so they don't grow the data the reads are measured on.
+SCENARIOS = ["search_recent", "search_keyword", "macro_get", "login", "save", "macro_save"]
+PASSWORD = "benchpassword"
+
+
+def seed_command(i):
+    #a handful of shapes, so keyword searches match a fraction of the rows rather than all or none.
+    shape = i % 4
+    if shape == 0:
+        return f"git commit -m 'bench change {i}' && git push origin feature/{i % 97}"
+    if shape == 1:
+        return f"docker run --rm -v /srv/data{i % 13}:/data bench/image:{i}"
+    if shape == 2:
+        return f"grep -rn 'pattern {i}' src/module{i % 31}"
+    return f"ssh deploy@host{i % 7}.example.com 'systemctl restart service{i}'"
+
+
+def login(url, username):
+    credentials = {"username": username, "password": PASSWORD}
+    response = httpx.post(url + "/login", data=credentials, timeout=60)
+    if response.status_code != 200:
+        httpx.post(url + "/register", data=credentials, timeout=60)
+        response = httpx.post(url + "/login", data=credentials, timeout=60)
+    response.raise_for_status()
+    return response.json()["msg"]
+
+
+def seed(url, size, macros, chunk):
+    """Returns the user's jwt, the macro names and a few command ids, after saving whatever is missing."""
+    username = f"bench_{size}"
+    jwt = login(url, username)
+    params = {"jwt": jwt}
+    #saved last, so an interrupted seed is picked up again on the next run.
+    seeded = "bench_seeded" in httpx.get(url + "/macros", params=params, timeout=60).json()["msg"]
+    if not seeded:
+        started = time.perf_counter()
+        for start in range(0, size, chunk):
+            response = httpx.post(url + "/commands/bulk", params=params, timeout=600,
+                                  json=[seed_command(i) for i in range(start, min(start + chunk, size))])
+            response.raise_for_status()
+        print(f"seeded {size} commands in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    ids = [row[0] for row in httpx.get(url + "/commands", params=dict(params, limit=macros * 5 + 5, sort="recent", include_ids="true"),
+                                       timeout=60).json()["msg"]]
+    names = [f"bench_macro_{n}" for n in range(macros)]
+    for n, name in enumerate(names):
+        #already saved ones answer 400, which is fine.
+        httpx.post(url + "/macro", params=params, data={"name": name, "commands": ",".join(map(str, ids[n * 5:n * 5 + 5]))}, timeout=60)
+    if not seeded:
+        httpx.post(url + "/macro", params=params, data={"name": "bench_seeded", "commands": str(ids[0])}, timeout=60).raise_for_status()
+    return jwt, names, ids[:5]
+
+
+def scenario_request(name, username, jwt, macro_names, macro_ids, keyword, limit, run_id):
+    """Returns a function sending one request of the scenario with the client it's given."""
+    counter = iter(range(10 ** 12))
+    params = {"jwt": jwt}
+    if name == "search_recent":
+        return lambda client: client.get("/commands", params=dict(params, limit=limit))
+    if name == "search_keyword":
+        return lambda client: client.get("/commands", params=dict(params, limit=limit, keyword=keyword))
+    if name == "macro_get":
+        return lambda client: client.get("/macro", params=dict(params, name=macro_names[next(counter) % len(macro_names)]))
+    if name == "login":
+        return lambda client: client.post("/login", data={"username": username, "password": PASSWORD})
+    if name == "save":
+        return lambda client: client.post("/commands", params=params, data={"command": f"echo bench save {run_id} {next(counter)}"})
+    if name == "macro_save":
+        commands = ",".join(map(str, macro_ids))
+        return lambda client: client.post("/macro", params=params, data={"name": f"bench_{run_id}_{next(counter)}", "commands": commands})
+    raise ValueError(f"unknown scenario {name}")
+
+
+async def load(url, send, concurrency, duration, warmup):
+    latencies = []
+    statuses = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+        async def worker(deadline, record):
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    status = (await send(client)).status_code
+                except httpx.HTTPError:
+                    status = "error"
+                if record:
+                    latencies.append(time.perf_counter() - start)
+                    statuses[status] = statuses.get(status, 0) + 1
+        if warmup:
+            deadline = time.perf_counter() + warmup
+            await asyncio.gather(*(worker(deadline, False) for _ in range(concurrency)))
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(*(worker(deadline, True) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    errors = sum(count for status, count in statuses.items() if status != 200)
+    return dict(summarize(latencies, elapsed, errors), statuses={str(status): count for status, count in statuses.items()})
+
+
+def environment(args, sql_url):
+    def git(*argv):
+        return subprocess.run(["git", *argv], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        #only the dialect+driver, the url may hold a password.
+        "database": sql_url.split("://")[0] if sql_url else os.getenv("SQL_BACKEND", "mysql"),
+        "mode": args.mode,
+        "options": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "sql_url")},
+    }
+
+
+def compare(baseline, results):
+    print(f"\n{'size':>9}  {'scenario':<16}{'clients':>8}{'req/s':>10}{'was':>10}{'p99 ms':>10}{'was':>10}")
+    for size, scenarios in results["results"].items():
+        for name, levels in scenarios.items():
+            for concurrency, new in levels.items():
+                old = baseline["results"].get(size, {}).get(name, {}).get(concurrency)
+                if old is None:
+                    continue
+                change = f"{(new['rps'] / old['rps'] - 1) * 100:+.0f}%" if old["rps"] else ""
+                print(f"{size:>9}  {name:<16}{concurrency:>8}{new['rps']:>10.1f}{old['rps']:>10.1f}"
+                      f"{new['p99_ms']:>10.1f}{old['p99_ms']:>10.1f}  {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="Commands saved per benchmark user, one user per size.")
+    parser.add_argument("--macros", type=int, default=50, help="Macros saved per benchmark user.")
+    parser.add_argument("--concurrency", default="1,16,64", help="Concurrent clients, each scenario runs at every level.")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds measured per scenario and level.")
+    parser.add_argument("--warmup", type=float, default=1, help="Seconds run before measuring, not counted.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--keyword", default="push origin", help="Keyword of search_keyword.")
+    parser.add_argument("--limit", type=int, default=20, help="Limit of both searches.")
+    parser.add_argument("--mode", choices=["threaded", "async"], default="threaded")
+    parser.add_argument("--sql-url", help="Database for the api (SQL_URL), eg. sqlite+aiosqlite:///bench.db.")
+    parser.add_argument("--seed-chunk", type=int, default=50000, help="Commands per /commands/bulk request while seeding.")
+    parser.add_argument("--response-cache", action="store_true", help="Keep the per-user response cache on, repeated reads are answered from memory then.")
+    parser.add_argument("--port", type=int, default=8120)
+    parser.add_argument("--output", help="Result file, defaults to bench-<commit>.json.")
+    parser.add_argument("--baseline", help="Result file of an earlier run to compare against.")
+    args = parser.parse_args()
+
+    env = {"SQL_ASYNC": "true" if args.mode == "async" else "false"}
+    if args.sql_url:
+        env["SQL_URL"] = args.sql_url
+    run = {"environment": environment(args, args.sql_url or os.getenv("SQL_URL")), "results": {}}
+    run_id = int(time.time())
+    proc, url = start_server(args.port, args.response_cache, **env)
+    try:
+        for size in map(int, args.sizes.split(",")):
+            jwt, macro_names, macro_ids = seed(url, size, args.macros, args.seed_chunk)
+            run["results"][str(size)] = scenarios = {}
+            for name in args.scenarios.split(","):
+                scenarios[name] = {}
+                for concurrency in map(int, args.concurrency.split(",")):
+                    #the level goes into the run id too, saves of one level would repeat the names and commands of the level before otherwise.
+                    send = scenario_request(name, f"bench_{size}", jwt, macro_names, macro_ids, args.keyword, args.limit, f"{run_id}_{concurrency}")
+                    r = scenarios[name][str(concurrency)] = asyncio.run(load(url, send, concurrency, args.duration, args.warmup))
+                    print(f"{size:>9}  {name:<16}{concurrency:>4} clients {r['rps']:>9.1f} req/s  p50 {r['p50_ms']:>7.1f} ms"
+                          f"  p99 {r['p99_ms']:>7.1f} ms  errors {r['errors']}", file=sys.stderr)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    output = args.output or f"bench-{run['environment']['commit'][:10]}.json"
+    with open(output, "w") as f:
+        json.dump(run, f, indent=1)
+    print(f"results written to {output}", file=sys.stderr)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), run)
+
+
+if __name__ == "__main__":
+    main()
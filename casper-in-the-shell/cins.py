@@ -1,26 +1,82 @@
 #!/usr/bin/env python3
 
-import argparse
+# Only modules costing next to nothing are imported up front, everything else (even json) is imported
+# by the function needing it, so the thin client talking to the daemon stays as small as possible.
 import os
-from getpass import getpass
-
-try:
-    import requests
-except ImportError:
-    print("requests library not found, installing...")
-    os.system("pip install requests")
-    import requests
+import sys
+import time
 
 
 # Define your API URL
-API_URL = "http://localhost:8002/api"
+API_URL = os.environ.get("CINS_API_URL", "http://localhost:8002/api")
+JWT_FILE = os.environ.get("CINS_JWT_FILE", "/tmp/cins_jwt")
+# Local replica of the user's commands and macros, kept current by "sync"
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "cins")
+CACHE_DB = os.path.join(CACHE_DIR, "cache.db")
+# Commands captured by the shell hook wait here, one json string per line, until the flusher sends them
+QUEUE_FILE = os.path.join(CACHE_DIR, "queue.ndjson")
+# Flusher retries with exponential backoff up to this many seconds between tries, then leaves the queue for the next one
+FLUSH_MAX_BACKOFF = 60
+FLUSH_MAX_TRIES = 8
+# "cins.py daemon" answers the subcommands below over this socket, keeping the http session, jwt and cache open
+DAEMON_SOCKET = os.path.join(CACHE_DIR, "daemon.sock")
+DAEMON_COMMANDS = {"search", "sc", "save", "sv", "macro-search", "msc", "macro-names", "mn", "macro-save", "msv", "hook"}
+# Request bodies at least this big are sent gzip compressed
+GZIP_MIN_BYTES = 1024
+# Saves/searches sent per /batch request
+BATCH_SIZE = 100
+
+_session = None
+
+def http():
+    # One keep-alive session per run, so a sync or an import reuses a single connection.
+    global _session
+    if _session is None:
+        try:
+            import requests
+        except ImportError:
+            sys.exit("cins.py needs the requests library, install it with: pip install requests")
+        _session = requests.Session()
+        _session.mount(API_URL, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+    return _session
+
+# Snapshots are read and written this many bytes at a time, whatever their size
+SNAPSHOT_CHUNK = 65536
+
+# Answers of GET requests kept in the local cache, for If-None-Match
+RESPONSES_KEPT = 200
+
+def get_json(url, params):
+    # Sends the ETag of the previous answer to the same request, the server answers 304 when it
+    # hasn't changed and the stored body is used. Returns the status code and the decoded body.
+    import json
+    db = open_cache()
+    key = json.dumps([url, jwt_user(params["jwt"]), sorted((k, str(v)) for k, v in params.items() if k != "jwt")])
+    row = db.execute("SELECT etag, body FROM responses WHERE key = ?", (key,)).fetchone()
+    response = http().get(url, params=params, headers={"If-None-Match": row[0]} if row else {})
+    if response.status_code == 304 and row:
+        return 200, json.loads(row[1])
+    if response.status_code == 200 and response.headers.get("ETag"):
+        with db:
+            db.execute("INSERT OR REPLACE INTO responses (key, etag, body) VALUES (?, ?, ?)", (key, response.headers["ETag"], response.content))
+            db.execute("DELETE FROM responses WHERE rowid NOT IN (SELECT rowid FROM responses ORDER BY rowid DESC LIMIT ?)", (RESPONSES_KEPT,))
+    return response.status_code, response.json()
+
+def post_body(url, body, content_type, params):
+    headers = {"Content-Type": content_type}
+    if len(body) >= GZIP_MIN_BYTES:
+        import gzip
+        body = gzip.compress(body, 6)
+        headers["Content-Encoding"] = "gzip"
+    return http().post(url, params=params, data=body, headers=headers)
 
 # Function to make the register request
 def register(username):
+    from getpass import getpass
     password = getpass(prompt="Enter your password: ")
     url = f"{API_URL}/register"
     payload = {'username': username, 'password': password}
-    response = requests.post(url, data=payload)
+    response = http().post(url, data=payload)
     if response.status_code == 200:
         print("Registration successful")
     else:
@@ -28,60 +84,113 @@ def register(username):
 
 # Function to make the login request and store the JWT token
 def login(username):
+    from getpass import getpass
     password = getpass(prompt="Enter your password: ")
     url = f"{API_URL}/login"
     payload = {'username': username, 'password': password}
-    response = requests.post(url, data=payload)
+    response = http().post(url, data=payload)
     if response.status_code == 200:
         jwt = response.json().get('msg')
-        with open('/tmp/cins_jwt', 'w') as f:
+        with open(JWT_FILE, 'w') as f:
             f.write(jwt)
         print("Login successful, JWT token saved.")
     else:
         print(f"Login failed: {response.status_code}: {response.json().get('detail')}")
 
 def command_search(keyword, limit,includeids,jwt):
+    import json
     url = f"{API_URL}/commands"
-    params = {'keyword': keyword,"limit":limit,"include_ids":includeids,"jwt":jwt}
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        search_result = response.json().get('msg')
-        if includeids:
-            for command in search_result:
-                print(command[0],command[1])
+    params = {'keyword': keyword,"limit":limit,"include_ids":includeids,"jwt":jwt,"stream":True}
+    # Results are streamed one command per line, so they are printed as soon as they arrive.
+    with http().get(url, params=params, stream=True) as response:
+        if response.status_code == 200:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                command = json.loads(line)
+                if includeids:
+                    print(command[0],command[1])
+                else:
+                    print(command[0])
         else:
-            for command in search_result:
-                print(command[0])
-    else:
-        print(f"Search failed: {response.status_code}: {response.json().get('detail')}")
+            print(f"Search failed: {response.status_code}: {response.json().get('detail')}")
 
 def command_save(command, jwt):
     url = f"{API_URL}/commands"
     params = {"jwt":jwt}
     payload = {'command': command}
-    response = requests.post(url,data=payload, params=params)
+    response = http().post(url,data=payload, params=params)
     if response.status_code == 200:
         print(response.json().get('msg')) 
     else:
         print(f"Save failed: {response.status_code}: {response.json().get('detail')}")
 
 
+def batch_send(items, jwt):
+    # Results come back in the order of items, None when the whole batch failed.
+    import json
+    url = f"{API_URL}/batch"
+    body = json.dumps({"requests": items}).encode("utf-8")
+    response = post_body(url, body, "application/json", {"jwt": jwt})
+    if response.status_code != 200:
+        print(f"Batch failed: {response.status_code}: {response.json().get('detail')}")
+        return None
+    return response.json().get("msg")
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def command_save_many(commands, batch_size, jwt):
+    for batch in batched(({"op": "save", "command": command} for command in commands), batch_size):
+        results = batch_send(batch, jwt)
+        if results is None:
+            return
+        for result in results:
+            if "msg" in result:
+                print(result["msg"])
+            else:
+                print(f"Save failed: {result['status_code']}: {result['detail']}")
+
+def batch_run(lines, batch_size, jwt):
+    # Scripted use, one json request per input line, eg. {"op": "search", "keyword": "git"}, one json result per output line.
+    import json
+    items = (json.loads(line) for line in lines if line.strip())
+    for batch in batched(items, batch_size):
+        results = batch_send(batch, jwt)
+        if results is None:
+            return
+        for result in results:
+            print(json.dumps(result))
+
+def stdin_commands():
+    for line in sys.stdin:
+        line = line.rstrip("\n")
+        if line.strip():
+            yield line
+
+
 def macro_search(name,jwt):
     url = f"{API_URL}/macro"
     params = {'name': name,"jwt":jwt}
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        search_result = response.json().get('msg')
-        for command in search_result:
+    status, result = get_json(url, params)
+    if status == 200:
+        for command in result.get('msg'):
             print(command)
     else:
-        print(f"Search failed: {response.status_code}: {response.json().get('detail')}")
+        print(f"Search failed: {status}: {result.get('detail')}")
 
 def macro_save(commands,name,jwt):
     url = f"{API_URL}/macro"
     params = {"jwt":jwt}
     payload = {'commands': commands,"name":name}
-    response = requests.post(url,data=payload, params=params)
+    response = http().post(url,data=payload, params=params)
     if response.status_code == 200:
         print(response.json().get('msg')) 
     else:
@@ -90,17 +199,653 @@ def macro_save(commands,name,jwt):
 def macro_names(jwt):
     url = f"{API_URL}/macros"
     params = {"jwt":jwt}
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        result = response.json().get('msg')
-        if not result:
+    status, result = get_json(url, params)
+    if status == 200:
+        if not result.get('msg'):
             print("No macros found.")
-        for macro_name in result:
+        for macro_name in result.get('msg'):
             print(macro_name)
     else:
-        print(f"Save failed: {response.status_code}: {response.json().get('detail')}")
+        print(f"Search failed: {status}: {result.get('detail')}")
+
+def read_bash_history(path):
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            # HISTTIMEFORMAT writes a "#<epoch>" line before each command.
+            if line.startswith("#") and line[1:].isdigit():
+                continue
+            yield line
+
+def read_zsh_history(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    # zsh "metafies" bytes above 0x83: they are stored as 0x83 followed by the byte xor 32.
+    if b"\x83" in data:
+        out = bytearray()
+        it = iter(data)
+        for byte in it:
+            out.append(next(it, 0) ^ 32 if byte == 0x83 else byte)
+        data = bytes(out)
+    command = None
+    for line in data.decode("utf-8", errors="replace").split("\n"):
+        if command is not None:
+            command += "\n" + line
+        elif line.startswith(": ") and ";" in line:
+            # extended history ": <start>:<elapsed>;<command>"
+            command = line.split(";", 1)[1]
+        else:
+            command = line
+        # a trailing backslash continues the command on the next line
+        if command.endswith("\\"):
+            command = command[:-1]
+            continue
+        yield command
+        command = None
+    if command:
+        yield command
+
+def read_fish_history(path):
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if line.startswith("- cmd: "):
+                raw = line[len("- cmd: "):].rstrip("\n")
+                # fish escapes backslashes and newlines inside cmd
+                command, escaped = [], False
+                for char in raw:
+                    if escaped:
+                        command.append("\n" if char == "n" else char)
+                        escaped = False
+                    elif char == "\\":
+                        escaped = True
+                    else:
+                        command.append(char)
+                yield "".join(command)
+
+HISTORY_READERS = {"bash": read_bash_history, "zsh": read_zsh_history, "fish": read_fish_history}
+
+def guess_shell(path):
+    name = os.path.basename(path)
+    for shell in ("zsh", "fish"):
+        if shell in name:
+            return shell
+    return "bash"
+
+def command_import(path, shell, batch_size, jwt):
+    import json
+    url = f"{API_URL}/commands/bulk"
+    params = {"jwt": jwt}
+    reader = HISTORY_READERS[shell or guess_shell(os.path.expanduser(path))]
+    seen = set()
+    batch = []
+    totals = {"received": 0, "saved": 0, "skipped": 0}
+
+    def send(batch):
+        body = "".join(json.dumps(command) + "\n" for command in batch)
+        response = post_body(url, body.encode("utf-8"), "application/x-ndjson", params)
+        if response.status_code != 200:
+            print(f"Import failed: {response.status_code}: {response.json().get('detail')}")
+            return False
+        for key, value in response.json().get("msg").items():
+            totals[key] += value
+        print(f"Imported {totals['saved']} commands so far...")
+        return True
+
+    for command in reader(os.path.expanduser(path)):
+        if not command.strip() or command in seen:
+            continue
+        seen.add(command)
+        batch.append(command)
+        if len(batch) >= batch_size:
+            if not send(batch):
+                return
+            batch = []
+    if batch and not send(batch):
+        return
+    print(f"Import done, {totals['saved']} commands saved, {totals['skipped']} skipped.")
+
+def snapshot_export(path, jwt):
+    # Written as the server gzip compressed it, or compressed here when it didn't, to a temporary
+    # file first so a broken download doesn't replace an older snapshot.
+    import zlib
+    response = http().get(f"{API_URL}/export", params={"jwt": jwt}, stream=True)
+    if response.status_code != 200:
+        print(f"Export failed: {response.status_code}: {response.json().get('detail')}")
+        return
+    deflater = None if response.headers.get("Content-Encoding") == "gzip" else zlib.compressobj(6, wbits=31)
+    partial = path + ".partial"
+    with open(partial, "wb") as f:
+        for chunk in response.raw.stream(SNAPSHOT_CHUNK, decode_content=False):
+            f.write(deflater.compress(chunk) if deflater else chunk)
+        if deflater:
+            f.write(deflater.flush())
+    os.replace(partial, path)
+    print(f"Exported to {path}, {os.path.getsize(path)} bytes.")
+
+def snapshot_restore(path, jwt):
+    with open(path, "rb") as f:
+        content_type = "application/gzip" if f.read(2) == b"\x1f\x8b" else "application/x-ndjson"
+        f.seek(0)
+        # Sent in chunks as it is read, the server inflates it on its side.
+        response = http().post(f"{API_URL}/import", params={"jwt": jwt}, headers={"Content-Type": content_type},
+                               data=iter(lambda: f.read(SNAPSHOT_CHUNK), b""))
+    if response.status_code != 200:
+        print(f"Restore failed: {response.status_code}: {response.json().get('detail')}")
+        return
+    result = response.json().get("msg")
+    print(f"Restored {result['commands']} commands and {result['macros']} macros, "
+          f"{result['skipped_macros']} macros skipped (name already used or no commands).")
+
+def hook(command):
+    # Called by the shell on every command, only appends to the queue and leaves the sending to "flush".
+    import fcntl
+    import json
+    if not command.strip() or command[0] == " ":
+        # a leading space hides a command, like bash's HISTCONTROL=ignorespace
+        return
+    line = (json.dumps(command) + "\n").encode("utf-8")
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    while True:
+        fd = os.open(QUEUE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # the flusher may have moved the file away between open and lock, append to the new one then
+            try:
+                current = os.stat(QUEUE_FILE).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                os.write(fd, line)
+                break
+        finally:
+            os.close(fd)
+    flush_in_background()
+
+def flush_in_background():
+    import fcntl
+    lock = open(QUEUE_FILE + ".lock", "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        # a flusher is running, it picks up what was just queued
+        return
+    finally:
+        lock.close()
+    import subprocess
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "flush", "--quiet"],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+def rotate_queue(sending):
+    # Moves the queue aside under the same lock "hook" appends with, new commands go to a fresh file.
+    import fcntl
+    try:
+        fd = os.open(QUEUE_FILE, os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if os.fstat(fd).st_size == 0:
+            return False
+        os.rename(QUEUE_FILE, sending)
+        return True
+    finally:
+        os.close(fd)
+
+def flush(jwt, quiet=False, linger=1.0):
+    import fcntl
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    lock = open(QUEUE_FILE + ".lock", "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | (fcntl.LOCK_NB if quiet else 0))
+    except BlockingIOError:
+        lock.close()
+        return
+    from requests import RequestException
+    url = f"{API_URL}/commands/bulk"
+    sending = QUEUE_FILE + ".sending"
+    progress = sending + ".sent"
+    # give commands typed right after this one a moment to join the same request
+    time.sleep(linger)
+    sent_total = 0
+    try:
+        while os.path.exists(sending) or rotate_queue(sending):
+            with open(sending, encoding="utf-8") as f:
+                lines = [line for line in f.read().split("\n") if line]
+            # lines of an earlier flusher that failed halfway were already saved, don't count them as uses again
+            done = 0
+            if os.path.exists(progress):
+                with open(progress) as f:
+                    done = int(f.read() or 0)
+            for batch in batched(lines[done:], BATCH_SIZE * 10):
+                delay = 1
+                for tries in range(1, FLUSH_MAX_TRIES + 1):
+                    try:
+                        response = post_body(url, ("\n".join(batch) + "\n").encode("utf-8"), "application/x-ndjson", {"jwt": jwt})
+                    except RequestException:
+                        response = None
+                    if response is not None and response.status_code < 500 and response.status_code != 429:
+                        break
+                    if tries == FLUSH_MAX_TRIES:
+                        if not quiet:
+                            print(f"Flush failed, {len(lines) - done} commands stay queued for the next try.")
+                        return
+                    time.sleep(delay)
+                    delay = min(delay * 2, FLUSH_MAX_BACKOFF)
+                if response.status_code == 401:
+                    if not quiet:
+                        print("Flush failed: 401: login again, queued commands are kept.")
+                    return
+                # only the server refusing the body itself means the lines are bad, they are dropped rather than retried forever.
+                # anything else (eg. a proxy's 403/404 or a wrong CINS_API_URL) keeps them for when it's sorted out.
+                if response.status_code not in (200, 400, 422):
+                    if not quiet:
+                        print(f"Flush failed: {response.status_code}: {len(lines) - done} commands stay queued for the next try.")
+                    return
+                done += len(batch)
+                sent_total += len(batch)
+                with open(progress, "w") as f:
+                    f.write(str(done))
+            os.remove(sending)
+            if os.path.exists(progress):
+                os.remove(progress)
+    finally:
+        lock.close()
+    if not quiet:
+        print(f"Flushed {sent_total} queued commands.")
+    if sent_total:
+        refresh_in_background(force=True)
+    if os.path.exists(QUEUE_FILE) and os.path.getsize(QUEUE_FILE):
+        # queued after the last look but before the lock was let go, nobody else started a flusher for it
+        flush_in_background()
+
+SHELL_HOOKS = {
+    "bash": """__cins_hook() {
+    local num cmd
+    read -r num cmd <<< "$(HISTTIMEFORMAT= history 1)"
+    [[ -n $cmd && $num != "$__cins_last" ]] || return
+    __cins_last=$num
+    ({cins} hook -- "$cmd" >/dev/null 2>&1 &)
+}
+read -r __cins_last _ <<< "$(HISTTIMEFORMAT= history 1)"
+PROMPT_COMMAND="__cins_hook${PROMPT_COMMAND:+;$PROMPT_COMMAND}"
+""",
+    "zsh": """__cins_hook() {
+    [[ -n $1 ]] && {cins} hook -- "$1" >/dev/null 2>&1 &!
+}
+autoload -Uz add-zsh-hook
+add-zsh-hook preexec __cins_hook
+""",
+    "fish": """function __cins_hook --on-event fish_preexec
+    {cins} hook -- $argv[1] >/dev/null 2>&1 &
+    disown
+end
+""",
+}
+
+def shell_init(shell):
+    import shlex
+    cins = shlex.join([sys.executable, os.path.abspath(__file__)])
+    print(SHELL_HOOKS[shell].replace("{cins}", cins), end="")
+
+def jwt_user(jwt):
+    # The payload is only read to tell users apart locally, the server is the one verifying it.
+    import base64
+    import json
+    payload = jwt.split(".")[1]
+    return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))).get("user")
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS commands (id INTEGER PRIMARY KEY, command TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS macros (id INTEGER PRIMARY KEY, name TEXT NOT NULL, commands TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, etag TEXT NOT NULL, body BLOB NOT NULL);
+"""
+# trigram tokenizer lets MATCH find any substring of 3+ characters, like the server side search.
+CACHE_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS commands_fts USING fts5(command, content='commands', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS commands_ai AFTER INSERT ON commands BEGIN
+    INSERT INTO commands_fts(rowid, command) VALUES (new.id, new.command);
+END;
+CREATE TRIGGER IF NOT EXISTS commands_ad AFTER DELETE ON commands BEGIN
+    INSERT INTO commands_fts(commands_fts, rowid, command) VALUES ('delete', old.id, old.command);
+END;
+"""
+# Local answers older than this trigger a background sync.
+CACHE_MAX_AGE = 30
 
-def main():
+_cache_db = None
+
+def open_cache():
+    # One connection per process, the daemon keeps using it between requests.
+    global _cache_db
+    if _cache_db is None:
+        _cache_db = connect_cache()
+    return _cache_db
+
+def connect_cache():
+    import sqlite3
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    db = sqlite3.connect(CACHE_DB, timeout=5)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(CACHE_SCHEMA)
+    try:
+        db.executescript(CACHE_FTS_SCHEMA)
+    except sqlite3.OperationalError:
+        # sqlite without fts5/trigram, searches fall back to LIKE.
+        pass
+    return db
+
+def cache_get(db, key, default=None):
+    row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def cache_set(db, key, value):
+    db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+def cache_owner(jwt):
+    return f"{API_URL} {jwt_user(jwt)}"
+
+def cache_ready(db, jwt):
+    # Only answer locally once a sync for this server and user has finished.
+    return cache_get(db, "owner") == cache_owner(jwt) and cache_get(db, "watermark") is not None
+
+def cache_has_fts(db):
+    return db.execute("SELECT 1 FROM sqlite_master WHERE name = 'commands_fts'").fetchone() is not None
+
+def cache_reset(db, jwt):
+    with db:
+        db.execute("DELETE FROM commands")
+        db.execute("DELETE FROM macros")
+        db.execute("DELETE FROM meta")
+        cache_set(db, "owner", cache_owner(jwt))
+
+def cache_watermark(db, jwt):
+    # A watermark from another server or user would skip commands, start over instead.
+    if cache_get(db, "owner") != cache_owner(jwt):
+        cache_reset(db, jwt)
+    return cache_get(db, "watermark", "")
+
+def cache_apply(db, result):
+    # Saves one /sync answer (or /ws/sync message) and its watermark.
+    import json
+    with db:
+        db.executemany("INSERT OR IGNORE INTO commands (id, command) VALUES (?, ?)", result["msg"]["commands"])
+        db.executemany("INSERT OR REPLACE INTO macros (id, name, commands) VALUES (?, ?, ?)",
+                       [(macro_id, name, json.dumps(commands)) for macro_id, name, commands in result["msg"]["macros"]])
+        cache_set(db, "watermark", result["watermark"])
+        cache_set(db, "synced_at", time.time())
+
+def sync(full, jwt, quiet=False):
+    import fcntl
+    db = open_cache()
+    # One sync at a time, background refreshes that find one running just leave.
+    lock = open(CACHE_DB + ".lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | (fcntl.LOCK_NB if quiet else 0))
+    except BlockingIOError:
+        return
+    url = f"{API_URL}/sync"
+    if full:
+        cache_reset(db, jwt)
+    watermark = cache_watermark(db, jwt)
+    new_commands = new_macros = 0
+    if not watermark:
+        # Everything in one streamed request, the pages below only fetch what was saved meanwhile.
+        exported = sync_from_export(db, jwt)
+        if exported:
+            watermark, new_commands, new_macros = exported
+    while True:
+        status, result = get_json(url, {"since": watermark, "jwt": jwt})
+        if status != 200:
+            if not quiet:
+                print(f"Sync failed: {status}: {result.get('detail')}")
+            return
+        watermark = result["watermark"]
+        cache_apply(db, result)
+        new_commands += len(result["msg"]["commands"])
+        new_macros += len(result["msg"]["macros"])
+        if not result["more"]:
+            break
+    if not quiet:
+        print(f"Synced {new_commands} new commands and {new_macros} new macros.")
+
+def sync_from_export(db, jwt):
+    # Fills an empty cache from /export, one line at a time. Returns the watermark and counts,
+    # or None (with nothing written) when the server has no export or the download broke.
+    import json
+    import requests
+    macros = {}
+    macro_commands = []
+    commands = []
+    command_id = macro_id = new_commands = 0
+    try:
+        response = http().get(f"{API_URL}/export", params={"jwt": jwt}, stream=True)
+        if response.status_code != 200:
+            return None
+        with db:
+            for line in response.iter_lines(SNAPSHOT_CHUNK, delimiter=b"\n"):
+                if not line:
+                    continue
+                row = json.loads(line)
+                if row[0] == "c":
+                    commands.append(row[1:3])
+                    command_id = row[1]
+                    if len(commands) >= 1000:
+                        db.executemany("INSERT OR IGNORE INTO commands (id, command) VALUES (?, ?)", commands)
+                        new_commands += len(commands)
+                        commands = []
+                elif row[0] == "m":
+                    macros[row[1]] = (row[2], [])
+                    macro_id = max(macro_id, row[1])
+                elif row[0] == "mc":
+                    macro_commands.append(row[1:])
+            db.executemany("INSERT OR IGNORE INTO commands (id, command) VALUES (?, ?)", commands)
+            new_commands += len(commands)
+            for macro, command, order in sorted(macro_commands, key=lambda row: (row[0], row[2])):
+                found = db.execute("SELECT command FROM commands WHERE id = ?", (command,)).fetchone()
+                if macro in macros and found:
+                    macros[macro][1].append(found[0])
+            db.executemany("INSERT OR REPLACE INTO macros (id, name, commands) VALUES (?, ?, ?)",
+                           [(macro, name, json.dumps(texts)) for macro, (name, texts) in macros.items()])
+            watermark = f"{command_id}.{macro_id}"
+            cache_set(db, "watermark", watermark)
+            cache_set(db, "synced_at", time.time())
+    except (requests.RequestException, ValueError):
+        return None
+    return watermark, new_commands, len(macros)
+
+def refresh_in_background(db=None, force=False):
+    # Detached "cins.py sync --quiet", the current command doesn't wait for it.
+    if not force and db is not None and time.time() - float(cache_get(db, "synced_at", 0)) < CACHE_MAX_AGE:
+        return
+    import subprocess
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "sync", "--quiet"],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+def local_command_search(db, keyword, limit, includeids):
+    limit = int(limit or 0) or -1
+    if keyword and len(keyword) >= 3 and cache_has_fts(db):
+        rows = db.execute("SELECT rowid, command FROM commands_fts WHERE commands_fts MATCH ? ORDER BY rowid DESC LIMIT ?",
+                          ('"' + keyword.replace('"', '""') + '"', limit))
+    else:
+        pattern = "%" + keyword.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        rows = db.execute("SELECT id, command FROM commands WHERE command LIKE ? ESCAPE '\\' ORDER BY id DESC LIMIT ?", (pattern, limit))
+    for command_id, command in rows:
+        if includeids:
+            print(command_id, command)
+        else:
+            print(command)
+
+def local_macro_search(db, name):
+    import json
+    if name:
+        row = db.execute("SELECT commands FROM macros WHERE name = ?", (name,)).fetchone()
+    else:
+        row = db.execute("SELECT commands FROM macros ORDER BY id DESC LIMIT 1").fetchone()
+    for command in json.loads(row[0]) if row else []:
+        print(command)
+
+def local_macro_names(db):
+    names = [name for name, in db.execute("SELECT name FROM macros ORDER BY id")]
+    if not names:
+        print("No macros found.")
+    for name in names:
+        print(name)
+
+_jwt = None
+
+def read_jwt():
+    # Reread only when login replaced the file, so a daemon holds on to the token in between.
+    global _jwt
+    try:
+        mtime = os.stat(JWT_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if _jwt is None or _jwt[0] != mtime:
+        with open(JWT_FILE, 'r') as f:
+            _jwt = (mtime, f.read().strip())
+    return _jwt[1]
+
+def run_in_daemon(argv):
+    # Thin client, hands the arguments to a running daemon and prints its answer.
+    # Returns False to run the command here instead, when there is no daemon or the command reads stdin.
+    # The exchange is plain bytes, json alone would double the cost of starting up:
+    # arguments separated by NUL, answered with "<exit code> <stdout length>\n<stdout><stderr>".
+    if not argv or argv[0] not in DAEMON_COMMANDS or "-" in argv[1:] or not os.path.exists(DAEMON_SOCKET):
+        return False
+    # the C module under "socket", which would import enum and selectors, half of the remaining startup time
+    import _socket
+    client = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        client.connect(DAEMON_SOCKET)
+    except OSError:
+        client.close()
+        return False
+    try:
+        client.sendall("\0".join(argv).encode("utf-8"))
+        client.shutdown(_socket.SHUT_WR)
+        data = b"".join(iter(lambda: client.recv(65536), b""))
+    finally:
+        client.close()
+    header, _, body = data.partition(b"\n")
+    if not header:
+        sys.exit("cins daemon closed the connection without answering.")
+    code, out_length = map(int, header.split())
+    sys.stdout.buffer.write(body[:out_length])
+    sys.stderr.buffer.write(body[out_length:])
+    sys.exit(code)
+
+def live_sync():
+    # Keeps a /ws/sync connection open next to the daemon and saves what the server pushes (commands and
+    # macros saved from any machine) into the cache as it arrives, reconnecting with backoff when it drops.
+    try:
+        from websockets.exceptions import WebSocketException
+        from websockets.sync.client import connect
+    except ImportError:
+        print("Live sync needs the websockets library (pip install -r requirements-cins.txt), the cache is refreshed by polling instead.")
+        return
+    import fcntl
+    import json
+    import threading
+    from urllib.parse import urlencode
+
+    def run():
+        # sqlite connections stay in the thread that opened them, the daemon's own one is busy answering.
+        db = connect_cache()
+        lock = open(CACHE_DB + ".lock", "w")
+        url = "ws" + API_URL[len("http"):] + "/ws/sync"
+        backoff = 1
+        while True:
+            jwt = read_jwt()
+            if jwt is not None:
+                try:
+                    with connect(f"{url}?{urlencode({'jwt': jwt, 'since': cache_watermark(db, jwt)})}", open_timeout=10) as ws:
+                        backoff = 1
+                        while read_jwt() == jwt:
+                            try:
+                                result = json.loads(ws.recv(timeout=CACHE_MAX_AGE / 2))
+                            except TimeoutError:
+                                # Nothing was saved meanwhile, the connection is still checked by websockets' pings.
+                                with db:
+                                    cache_set(db, "synced_at", time.time())
+                                continue
+                            fcntl.flock(lock, fcntl.LOCK_EX)
+                            try:
+                                cache_apply(db, result)
+                            finally:
+                                fcntl.flock(lock, fcntl.LOCK_UN)
+                except (OSError, WebSocketException, ValueError):
+                    pass
+                if read_jwt() != jwt:
+                    # logged in again (maybe as someone else), reconnect with the new token right away
+                    continue
+            time.sleep(backoff)
+            backoff = min(backoff * 2, FLUSH_MAX_BACKOFF)
+
+    threading.Thread(target=run, name="live-sync", daemon=True).start()
+
+def daemon():
+    import contextlib
+    import io
+    import signal
+    import socket
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if os.path.exists(DAEMON_SOCKET):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(DAEMON_SOCKET)
+            print("A cins daemon is already running.")
+            return
+        except OSError:
+            # left behind by a daemon that was killed
+            os.remove(DAEMON_SOCKET)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(DAEMON_SOCKET)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    # import what the commands need once, instead of on the first request
+    http()
+    open_cache()
+    live_sync()
+    print(f"cins daemon listening on {DAEMON_SOCKET}")
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                conn.settimeout(5)
+                out, err = io.StringIO(), io.StringIO()
+                code = 0
+                try:
+                    argv = b"".join(iter(lambda: conn.recv(65536), b"")).decode("utf-8").split("\0")
+                    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                        try:
+                            main(argv)
+                        except SystemExit as e:
+                            if isinstance(e.code, str):
+                                print(e.code, file=sys.stderr)
+                            code = e.code if isinstance(e.code, int) else int(e.code is not None)
+                        except Exception as e:
+                            print(f"cins daemon: {e!r}", file=sys.stderr)
+                            code = 1
+                    out, err = out.getvalue().encode("utf-8"), err.getvalue().encode("utf-8")
+                    conn.sendall(f"{code} {len(out)}\n".encode() + out + err)
+                except (OSError, ValueError):
+                    # client went away or sent garbage, the next one is served anyway
+                    continue
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(DAEMON_SOCKET)
+
+def main(argv=None):
+    import argparse
     # Set up argparse
     parser = argparse.ArgumentParser(description="Casper in the Shell (cins) - CLI tool")
     # Define subcommands
@@ -119,45 +864,128 @@ def main():
     search_parser.add_argument('-kw', '--keyword',default="", required=False, help="Keyword to search for")
     search_parser.add_argument('-l', '--limit',default=0, required=False, help="Limit returned command count, not using this will return all commands that match.")
     search_parser.add_argument('-ii', '--includeids',default=False, required=False, help="Include ids to create macros from.")
+    search_parser.add_argument('--remote', action='store_true', help="Ask the server instead of the local cache.")
 
     save_parser = subparsers.add_parser('save', help="Save a command",aliases=['sv'])
-    save_parser.add_argument('-cmd', '--command', required=True, help="Command to save")
+    save_parser.add_argument('stdin', nargs='?', choices=['-'], help="Read commands to save from stdin, one per line.")
+    save_parser.add_argument('-cmd', '--command', action='append', default=[], help="Command to save, can be given more than once.")
+    save_parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE, required=False, help="Commands sent per request when saving more than one.")
+
+    batch_parser = subparsers.add_parser('batch', help="Send saves and searches read as json lines, eg. {\"op\": \"search\", \"keyword\": \"git\"}")
+    batch_parser.add_argument('-f', '--file', default="-", required=False, help="File to read requests from, stdin by default.")
+    batch_parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE, required=False, help="Requests sent per round trip.")
+
+    import_parser = subparsers.add_parser('import', help="Upload a bash, zsh or fish history file")
+    import_parser.add_argument('-f', '--file', required=True, help="History file to upload, eg. ~/.bash_history")
+    import_parser.add_argument('-s', '--shell', choices=sorted(HISTORY_READERS), required=False, help="History format, guessed from the file name if not given.")
+    import_parser.add_argument('-b', '--batch-size', type=int, default=1000, required=False, help="Commands sent per request.")
+
+    sync_parser = subparsers.add_parser('sync', help="Fetch commands and macros saved since the last sync")
+    sync_parser.add_argument('--full', action='store_true', help="Drop the local cache and fetch everything.")
+    sync_parser.add_argument('--quiet', action='store_true', help="Print nothing, skip if another sync is running.")
+
+    hook_parser = subparsers.add_parser('hook', help="Queue a command to be saved in the background, for shell hooks")
+    hook_parser.add_argument('command', help="Command that was run, put -- before it.")
+
+    flush_parser = subparsers.add_parser('flush', help="Send the commands queued by hook")
+    flush_parser.add_argument('--quiet', action='store_true', help="Print nothing, skip if another flush is running.")
+
+    subparsers.add_parser('daemon', help="Stay running and answer searches, saves and hooks over a unix socket, so each call starts faster")
+
+    shell_init_parser = subparsers.add_parser('shell-init', help="Print the hook for your shell, eg. eval \"$(./cins.py shell-init bash)\" in ~/.bashrc")
+    shell_init_parser.add_argument('shell', choices=sorted(SHELL_HOOKS), help="Shell to print the hook for.")
 
     macro_search_parser = subparsers.add_parser('macro-search', help="Fetch commands of given macro name",aliases=['msc'])
     macro_search_parser.add_argument('-n', '--name',default="", required=False, help="Name of macro to fetch commands")
+    macro_search_parser.add_argument('--remote', action='store_true', help="Ask the server instead of the local cache.")
 
     macro_fetch_parser = subparsers.add_parser('macro-names', help="Fetch all user saved macro names",aliases=['mn'])
+    macro_fetch_parser.add_argument('--remote', action='store_true', help="Ask the server instead of the local cache.")
 
     macro_save_parser = subparsers.add_parser('macro-save', help="Save a macro",aliases=['msv'])
     macro_save_parser.add_argument('-n', '--name', required=True, help="Name of macro to fetch commands")
     macro_save_parser.add_argument('-cmds', '--commands', required=True, help="Command ids to save(comma or whitespace seperated.)")
+
+    export_parser = subparsers.add_parser('export', help="Download everything you saved as a gzip compressed snapshot file")
+    export_parser.add_argument('-o', '--output', default="cins-snapshot.ndjson.gz", required=False, help="File to write the snapshot to.")
+
+    restore_parser = subparsers.add_parser('restore', help="Upload a snapshot made by export, eg. to move to another server")
+    restore_parser.add_argument('-f', '--file', required=True, help="Snapshot file to upload.")
     # Parse arguments
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     # Execute based on subcommand
     if args.subargument == "register":
         register(args.username)
+    elif args.subargument == "hook":
+        # No login check here, the queue is kept until a flush can send it.
+        hook(args.command)
+    elif args.subargument == "shell-init":
+        shell_init(args.shell)
+    elif args.subargument == "daemon":
+        daemon()
     elif args.subargument == "login":
         login(args.username)
-    elif args.subargument in ["search", "sc", "save", "sv","macro-search","msc","macro-save","msv","macro-names","mn"]:
+    elif args.subargument in ["search", "sc", "save", "sv","macro-search","msc","macro-save","msv","macro-names","mn","import","sync","batch","flush","export","restore"]:
         # Check if JWT file exists
-        if os.path.exists('/tmp/cins_jwt'):
-            with open('/tmp/cins_jwt', 'r') as f:
-                jwt = f.read().strip()
-            if args.subargument in ["search", "sc"]:
-                command_search(args.keyword,args.limit,args.includeids,jwt)
+        jwt = read_jwt()
+        if jwt is not None:
+            if args.subargument in ["search", "sc", "macro-search", "msc", "macro-names", "mn"]:
+                db = None if args.remote else open_cache()
+                if db is not None and cache_ready(db, jwt):
+                    if args.subargument in ["search", "sc"]:
+                        local_command_search(db, args.keyword, args.limit, args.includeids)
+                    elif args.subargument in ["macro-search", "msc"]:
+                        local_macro_search(db, args.name)
+                    else:
+                        local_macro_names(db)
+                    refresh_in_background(db)
+                    return
+                if args.subargument in ["search", "sc"]:
+                    command_search(args.keyword,args.limit,args.includeids,jwt)
+                elif args.subargument in ["macro-search", "msc"]:
+                    macro_search(args.name, jwt)
+                else:
+                    macro_names(jwt)
+                if db is not None:
+                    refresh_in_background(db)
             elif args.subargument in ["save", "sv"]:
-                command_save(args.command, jwt)
-            elif args.subargument in ["macro-search", "msc"]:
-                macro_search(args.name, jwt)
+                if args.stdin:
+                    command_save_many(stdin_commands(), args.batch_size, jwt)
+                elif len(args.command) == 1:
+                    command_save(args.command[0], jwt)
+                elif args.command:
+                    command_save_many(args.command, args.batch_size, jwt)
+                else:
+                    save_parser.error("give a command with -cmd, or - to read them from stdin")
+                refresh_in_background(force=True)
             elif args.subargument in ["macro-save", "msv"]:
                 macro_save(args.commands,args.name, jwt)
-            elif args.subargument in ["macro-names", "mn"]:
-                macro_names(jwt)
+                refresh_in_background(force=True)
+            elif args.subargument == "import":
+                command_import(args.file, args.shell, args.batch_size, jwt)
+                refresh_in_background(force=True)
+            elif args.subargument == "sync":
+                sync(args.full, jwt, args.quiet)
+            elif args.subargument == "export":
+                snapshot_export(os.path.expanduser(args.output), jwt)
+            elif args.subargument == "restore":
+                snapshot_restore(os.path.expanduser(args.file), jwt)
+                refresh_in_background(force=True)
+            elif args.subargument == "flush":
+                flush(jwt, args.quiet)
+            elif args.subargument == "batch":
+                if args.file == "-":
+                    batch_run(sys.stdin, args.batch_size, jwt)
+                else:
+                    with open(os.path.expanduser(args.file), encoding="utf-8") as f:
+                        batch_run(f, args.batch_size, jwt)
+                refresh_in_background(force=True)
         else:
             print("JWT token not found. Please login first.")
     else:
         print("Casper in the Shell (cins) - CLI tool")
         print("Use -h or --help to see all arguments")
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if not run_in_daemon(sys.argv[1:]):
+        main()
\ No newline at end of file
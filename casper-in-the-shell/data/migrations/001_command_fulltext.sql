@@ -0,0 +1,4 @@
+-- Fulltext index used by keyword search on /commands, for databases created before it was added to tables.sql.
+-- Run with innodb_ft_enable_stopword=OFF so ngrams containing stopwords are indexed too.
+SET SESSION innodb_ft_enable_stopword = OFF;
+ALTER TABLE `commands` ADD FULLTEXT KEY `command_fulltext` (`command`) WITH PARSER `ngram`;
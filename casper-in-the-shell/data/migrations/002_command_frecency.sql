@@ -0,0 +1,9 @@
+-- Usage counts and frecency ranking for commands.
+-- Existing commands start with one use at migration time, ordered by id within the same score.
+ALTER TABLE `commands`
+  ADD COLUMN `hits` int NOT NULL DEFAULT '1',
+  ADD COLUMN `last_used` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  ADD COLUMN `frecency` double NOT NULL DEFAULT '0',
+  ADD KEY `user_frecency` (`user_id`,`frecency`);
+-- Same formula as app/utils.py frecency_now: (now - FRECENCY_EPOCH) / FRECENCY_HALF_LIFE.
+UPDATE `commands` SET `frecency` = (UNIX_TIMESTAMP() - 1704067200) / (7 * 24 * 3600);
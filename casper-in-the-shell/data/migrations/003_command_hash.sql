@@ -0,0 +1,13 @@
+-- Per-user uniqueness on an 8 byte content hash instead of the (user_id, command) varchar key,
+-- commands become TEXT so they can be longer than 511 characters.
+-- Same hash as app/utils.py command_hash: the first 8 bytes of SHA-256 over the utf8mb4 (utf-8) bytes.
+-- Commands only differing in case or accents were duplicates under the old key, they aren't anymore.
+ALTER TABLE `commands`
+  ADD COLUMN `command_hash` binary(8) DEFAULT NULL AFTER `command`,
+  ADD KEY `user_recent` (`user_id`,`id`);
+UPDATE `commands` SET `command_hash` = UNHEX(LEFT(SHA2(`command`, 256), 16));
+ALTER TABLE `commands`
+  MODIFY `command_hash` binary(8) NOT NULL,
+  MODIFY `command` text NOT NULL,
+  ADD UNIQUE KEY `user_command_hash` (`user_id`,`command_hash`),
+  DROP KEY `user_id`;
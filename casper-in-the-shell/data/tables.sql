@@ -25,9 +25,16 @@ DROP TABLE IF EXISTS `commands`;
 CREATE TABLE `commands` (
   `id` int NOT NULL AUTO_INCREMENT,
   `user_id` int NOT NULL,
-  `command` varchar(511) DEFAULT NULL,
+  `command` text NOT NULL,
+  `command_hash` binary(8) NOT NULL,
+  `hits` int NOT NULL DEFAULT '1',
+  `last_used` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `frecency` double NOT NULL DEFAULT '0',
   PRIMARY KEY (`id`),
-  UNIQUE KEY `user_id` (`user_id`,`command`),
+  UNIQUE KEY `user_command_hash` (`user_id`,`command_hash`),
+  KEY `user_recent` (`user_id`,`id`),
+  KEY `user_frecency` (`user_id`,`frecency`),
+  FULLTEXT KEY `command_fulltext` (`command`) /*!50100 WITH PARSER `ngram` */ ,
   CONSTRAINT `commands_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE CASCADE
 ) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;